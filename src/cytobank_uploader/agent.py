@@ -0,0 +1,415 @@
+"""A local agent that keeps sessions, tokens and caches warm between invocations.
+
+The agent listens on a Unix socket.  Each connection carries a single request, one
+line of JSON of the form `{"command": ..., "args": {...}}`, and receives a single
+line of JSON in reply: `{"ok": true, "result": ...}` or
+`{"ok": false, "error": ..., "type": ...}`.
+"""
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+from datetime import datetime, timezone
+from functools import partial
+from pathlib import Path
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Any, Callable, Optional, Tuple
+
+import requests
+from loguru import logger
+
+from .interface import (
+    InvalidTokenError,
+    _get_auth_token,
+    _get_experiment_fcs_files_info,
+    _get_experiments,
+    _upload_files,
+    get_upload_token,
+    test_token,
+)
+from .output import _as_datetime, _plain
+from .planner import ThroughputHistory
+from .progress import TransferProgress
+
+# how long upload credentials are kept when they do not say when they expire
+UPLOAD_TOKEN_TTL = 30 * 60.0
+# credentials are renewed this many seconds before they expire, so that they do not
+# run out partway through an upload
+UPLOAD_TOKEN_MARGIN = 5 * 60.0
+EXPERIMENTS_TTL = 60.0
+# how long commands wait for the agent to answer anything other than an upload before
+# doing the work themselves
+REQUEST_TIMEOUT = 30.0
+
+
+class AgentUnavailable(Exception):
+    pass
+
+
+class AgentError(Exception):
+    pass
+
+
+def agent_socket() -> Path:
+    """Path to the agent's socket.  Can be changed with `CYTOBANK_AGENT_SOCKET`.
+
+    The socket is placed in `$XDG_RUNTIME_DIR` if it is set.  Otherwise it goes in
+    the home directory, named after the host, since a home directory shared between
+    the nodes of a cluster would otherwise hold one socket for all of them.
+    """
+    if "CYTOBANK_AGENT_SOCKET" in os.environ:
+        return Path(os.environ["CYTOBANK_AGENT_SOCKET"])
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return Path(os.environ["XDG_RUNTIME_DIR"]) / "cytobank-agent.sock"
+    return Path.home() / f".cytobank-agent-{socket.gethostname()}.sock"
+
+
+def _owner_file(path: Path) -> Path:
+    """File recording the host and process id of the agent listening on `path`"""
+    return path.with_name(f"{path.name}.pid")
+
+
+def call_agent(command: str, timeout: Optional[float] = None, **args: Any) -> Any:
+    """Send a request to the agent and wait for its reply.
+
+    Raises
+    ------
+    AgentUnavailable
+        If the agent is not running, cannot be reached, did not reply within
+        `timeout` seconds, or handing off to it has been disabled by setting
+        `CYTOBANK_NO_AGENT`
+    InvalidTokenError
+        If the agent found the authorization token to be invalid
+    AgentError
+        If the request failed in the agent for any other reason
+    """
+    if os.environ.get("CYTOBANK_NO_AGENT"):
+        raise AgentUnavailable("handing off to the agent is disabled")
+
+    path = agent_socket()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(str(path))
+        except OSError as e:
+            raise AgentUnavailable(
+                f"could not connect to an agent on {path}: {e}"
+            ) from e
+        try:
+            with sock.makefile("rwb") as stream:
+                stream.write(
+                    f"{json.dumps({'command': command, 'args': args})}\n".encode()
+                )
+                stream.flush()
+                reply = stream.readline()
+        except socket.timeout as e:
+            raise AgentUnavailable(
+                f"the agent on {path} did not reply within {timeout} seconds"
+            ) from e
+
+    if not reply:
+        raise AgentError("the agent closed the connection without replying")
+    response = json.loads(reply)
+    if response["ok"]:
+        return response["result"]
+    if response["type"] == "InvalidTokenError":
+        raise InvalidTokenError(message=response["error"])
+    raise AgentError(f"{response['type']}: {response['error']}")
+
+
+def _upload_token_deadline(upload_token: dict[str, Any]) -> float:
+    """The time, on the `monotonic()` clock, after which upload credentials should no
+    longer be used, from the expiration they were issued with if there is one"""
+    expiration = upload_token.get("expiration")
+    now = datetime.now(timezone.utc)
+    if isinstance(expiration, (int, float)) and not isinstance(expiration, bool):
+        # seconds since the epoch
+        remaining = expiration - now.timestamp()
+    elif (expires_at := _as_datetime(expiration)) is not None:
+        remaining = (expires_at - now.replace(tzinfo=None)).total_seconds()
+    else:
+        return monotonic() + UPLOAD_TOKEN_TTL
+    return monotonic() + remaining - UPLOAD_TOKEN_MARGIN
+
+
+def agent_running() -> bool:
+    try:
+        call_agent("ping", timeout=1.0)
+    except (AgentUnavailable, AgentError, OSError):
+        return False
+    return True
+
+
+class Agent(object):
+    """Holds the state that is kept between requests: a shared HTTP session, tokens
+    that have already been validated, upload credentials, and the experiment listing.
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.started = monotonic()
+        self._lock = Lock()
+        self._auth_tokens: dict[str, str] = {}
+        # upload credentials and the time at which they should be renewed
+        self._upload_tokens: dict[
+            Tuple[str, int, str], Tuple[float, dict[str, Any]]
+        ] = {}
+        self._experiments: dict[
+            Tuple[str, str], Tuple[float, list[dict[str, Any]]]
+        ] = {}
+        self.commands: dict[str, Callable[..., Any]] = {
+            "ping": self.ping,
+            "auth_token": self.auth_token,
+            "list_experiments": self.list_experiments,
+            "list_fcs_files": self.list_fcs_files,
+            "upload_files": self.upload_files,
+        }
+
+    def dispatch(self, request: dict[str, Any]) -> dict[str, Any]:
+        command = request.get("command")
+        logger.debug(f"agent received {command}")
+        if command not in self.commands:
+            return {
+                "ok": False,
+                "error": f"unknown command {command}",
+                "type": "ValueError",
+            }
+        try:
+            result = self.commands[command](**request.get("args", {}))
+        except Exception as e:
+            logger.exception(e)
+            return {"ok": False, "error": str(e), "type": type(e).__name__}
+        return {"ok": True, "result": result}
+
+    def _validate(self, auth_token: Optional[str], cytobank_domain: str) -> str:
+        if auth_token is None:
+            return self.auth_token(cytobank_domain)
+        # test_token remembers tokens it has found to be valid
+        if not test_token(auth_token, cytobank_domain):
+            raise InvalidTokenError(auth_token)
+        return auth_token
+
+    def ping(self) -> dict[str, Any]:
+        return {"pid": os.getpid(), "uptime": monotonic() - self.started}
+
+    def auth_token(self, cytobank_domain: str = "premium") -> str:
+        """The stored authorization token, read from the config file only once"""
+        with self._lock:
+            token = self._auth_tokens.get(cytobank_domain)
+        if token is not None and test_token(token, cytobank_domain):
+            return token
+        token = _get_auth_token(cytobank_domain=cytobank_domain)
+        with self._lock:
+            self._auth_tokens[cytobank_domain] = token
+        return token
+
+    def list_experiments(
+        self, cytobank_domain: str = "premium", auth_token: Optional[str] = None
+    ) -> list[dict[str, Any]]:
+        auth_token = self._validate(auth_token, cytobank_domain)
+        key = (cytobank_domain, auth_token)
+        with self._lock:
+            cached = self._experiments.get(key)
+        if cached is not None and monotonic() - cached[0] < EXPERIMENTS_TTL:
+            return cached[1]
+        experiments = [
+            {k: _plain(v) for k, v in _.to_dict().items()}
+            for _ in _get_experiments(
+                cytobank_domain=cytobank_domain,
+                auth_token=auth_token,
+                session=self.session,
+            )
+        ]
+        with self._lock:
+            self._experiments[key] = (monotonic(), experiments)
+        return experiments
+
+    def list_fcs_files(
+        self,
+        experimentId: int,
+        cytobank_domain: str = "premium",
+        auth_token: Optional[str] = None,
+    ) -> list[dict[str, Any]]:
+        auth_token = self._validate(auth_token, cytobank_domain)
+        return _get_experiment_fcs_files_info(
+            experimentId=experimentId,
+            cytobank_domain=cytobank_domain,
+            auth_token=auth_token,
+            session=self.session,
+        )
+
+    def _upload_token(
+        self, username: str, exp_id: int, cytobank_domain: str, auth_token: str
+    ) -> dict[str, Any]:
+        key = (username, exp_id, cytobank_domain)
+        with self._lock:
+            cached = self._upload_tokens.get(key)
+        if cached is not None and monotonic() < cached[0]:
+            return cached[1]
+        upload_token = get_upload_token(username, exp_id, cytobank_domain, auth_token)
+        self._store_upload_token(key, upload_token)
+        return upload_token
+
+    def _store_upload_token(
+        self, key: Tuple[str, int, str], upload_token: Optional[dict[str, Any]]
+    ) -> None:
+        """Keep new upload credentials, or forget the old ones if None"""
+        with self._lock:
+            if upload_token is None:
+                self._upload_tokens.pop(key, None)
+            else:
+                self._upload_tokens[key] = (
+                    _upload_token_deadline(upload_token),
+                    upload_token,
+                )
+
+    def upload_files(
+        self,
+        files: list[str],
+        username: str,
+        exp_id: int,
+        cytobank_domain: str = "premium",
+        auth_token: Optional[str] = None,
+        concurrency: int = 10,
+        max_attempts: int = 5,
+    ) -> list[dict[str, Any]]:
+        auth_token = self._validate(auth_token, cytobank_domain)
+        outcomes = _upload_files(
+            files=[Path(_) for _ in files],
+            username=username,
+            exp_id=exp_id,
+            cytobank_domain=cytobank_domain,
+            auth_token=auth_token,
+            concurrency=concurrency,
+            history=ThroughputHistory(),
+            max_attempts=max_attempts,
+            # "none" records nothing, so nothing builds up in a long-lived agent
+            progress=TransferProgress(mode="none"),
+            upload_token=self._upload_token(
+                username, exp_id, cytobank_domain, auth_token
+            ),
+            # the credentials are replaced during the upload if they expire
+            on_upload_token=partial(
+                self._store_upload_token, (username, exp_id, cytobank_domain)
+            ),
+        )
+        return [_.to_dict() for _ in outcomes]
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: "AgentServer"
+
+    def handle(self) -> None:
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response = {"ok": False, "error": str(e), "type": "ValueError"}
+        else:
+            if request.get("command") == "shutdown":
+                response = {"ok": True, "result": None}
+                # shutdown() waits for serve_forever() to return, so it cannot be
+                # called from the thread handling this request
+                Thread(target=self.server.shutdown, daemon=True).start()
+            else:
+                response = self.server.agent.dispatch(request)
+        self.wfile.write(f"{json.dumps(response)}\n".encode())
+
+
+class AgentServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: Path, agent: Optional[Agent] = None):
+        self.agent = agent if agent is not None else Agent()
+        self.path = path
+        # the socket hands out tokens, so only the current user may connect.  It is
+        # created with those permissions, rather than changed afterwards, so that there
+        # is no moment at which anyone else could connect.
+        umask = os.umask(0o077)
+        try:
+            super().__init__(str(path), _RequestHandler)
+        finally:
+            os.umask(umask)
+
+
+def _remove_stale_socket(path: Path) -> None:
+    """Remove the socket left behind by an agent that is known to have exited.
+
+    A socket on a shared filesystem may belong to an agent on another host, which
+    cannot be connected to from here, so the socket is only removed if it was created
+    on this host by a process that no longer exists.
+    """
+    if agent_running():
+        raise AgentError(f"an agent is already listening on {path}")
+    owner = _owner_file(path)
+    try:
+        hostname, pid = owner.read_text().split()
+    except (OSError, ValueError):
+        hostname, pid = None, "0"
+    if hostname == socket.gethostname():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            logger.debug(f"removing stale socket {path}")
+            path.unlink(missing_ok=True)
+            owner.unlink(missing_ok=True)
+            return
+        except PermissionError:
+            pass
+    raise AgentError(
+        f"{path} may belong to an agent that is still running; "
+        "remove it if you are sure it does not"
+    )
+
+
+def serve(path: Optional[Path] = None) -> None:
+    """Run the agent in the foreground until it is told to shut down"""
+    if path is None:
+        path = agent_socket()
+    if path.exists():
+        _remove_stale_socket(path)
+
+    with AgentServer(path) as server:
+        owner = _owner_file(path)
+        owner.write_text(f"{socket.gethostname()} {os.getpid()}\n")
+        logger.info(f"agent listening on {path}")
+        try:
+            server.serve_forever()
+        finally:
+            path.unlink(missing_ok=True)
+            owner.unlink(missing_ok=True)
+            server.agent.session.close()
+
+
+def start(timeout: float = 10.0) -> int:
+    """Start the agent in the background and wait until it is accepting requests
+
+    Returns
+    -------
+    int
+        The process id of the agent
+    """
+    process = subprocess.Popen(
+        [sys.executable, "-m", "cytobank_uploader.agent"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if agent_running():
+            return process.pid
+        if process.poll() is not None:
+            raise AgentError(f"the agent exited with code {process.returncode}")
+        sleep(0.1)
+    raise AgentError(f"the agent did not start within {timeout} seconds")
+
+
+if __name__ == "__main__":
+    serve()
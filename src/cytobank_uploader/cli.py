@@ -1,25 +1,36 @@
 # TODO: need more error checking and handling
 from datetime import datetime
-import json
 from pathlib import Path
 from pprint import pprint
 from sys import stderr
-from typing import Optional
+from typing import Iterator, Optional
 
-import requests
 import typer
 from loguru import logger
 from rich.console import Console
+from rich.table import Table
 from rich.traceback import install
+from tqdm import tqdm
 
-from . import __version__
+from . import __version__, agent
+from .agent import REQUEST_TIMEOUT, AgentUnavailable, call_agent
+from .download import _download_experiment_files
 from .experiments import Experiment
 from .interface import (
+    InvalidTokenError,
     _get_auth_token,
-    _list_experiment_fcs_files,
+    _get_experiment_fcs_file_ids,
+    _get_experiment_fcs_files_info,
+    _get_experiments,
     _upload_files,
-    get_upload_token,
+    _wait_for_ingest,
+    test_token,
 )
+from .output import OUTPUT_FORMATS, filter_records, split_fields, write_records
+from .planner import ThroughputHistory, UploadPlan, plan_upload
+from .profiling import DEFAULT_SAMPLE_INTERVAL, profile
+from .progress import PROGRESS_MODES, TransferProgress
+from .retry import UploadOutcome, write_report
 
 install(show_locals=True)
 
@@ -44,17 +55,98 @@ app = typer.Typer(
     rich_markup_mode="markdown",
 )
 
+# shared by every command
+PROFILE_OPTION = typer.Option(
+    None,
+    "--profile",
+    help="Write a CPU profile and the time spent in each phase (auth, token probe, listing, ...) to this file, as JSON",
+)
+PROFILE_SAMPLING_OPTION = typer.Option(
+    None,
+    "--profile-sampling",
+    help="When profiling, also sample every thread's stack at this interval, in seconds",
+)
 
-def unpack(iterable):
-    logger.debug(f"{iterable=}")
-    for i in iterable:
-        logger.debug(f"{i=}")
-        if "__iter__" in dir(i):
-            for j in i:
-                logger.debug(f"{j=}")
-                yield j
-        else:
-            yield i
+
+def resolve_auth_token(auth_token: Optional[str], cytobank_domain: str) -> str:
+    """Use the token that was passed, otherwise the one held by the agent if it is
+    running, otherwise the stored token"""
+    if auth_token is not None:
+        return auth_token
+    try:
+        token: str = call_agent(
+            "auth_token", timeout=REQUEST_TIMEOUT, cytobank_domain=cytobank_domain
+        )
+    except AgentUnavailable:
+        token = _get_auth_token(cytobank_domain=cytobank_domain)
+    return token
+
+
+def experiments_from_agent_or_api(
+    cytobank_domain: str, auth_token: str
+) -> Iterator[Experiment]:
+    try:
+        records = call_agent(
+            "list_experiments",
+            timeout=REQUEST_TIMEOUT,
+            cytobank_domain=cytobank_domain,
+            auth_token=auth_token,
+        )
+    except AgentUnavailable:
+        return _get_experiments(cytobank_domain=cytobank_domain, auth_token=auth_token)
+    return (Experiment.from_dict(_) for _ in records)
+
+
+def check_output_format(output_format: str) -> None:
+    if output_format not in OUTPUT_FORMATS:
+        raise typer.BadParameter(
+            f"must be one of {', '.join(OUTPUT_FORMATS)}", param_hint="--format"
+        )
+
+
+def print_upload_plan(
+    plan: UploadPlan,
+    cytobank_domain: str,
+    concurrency: int,
+    history: Optional[ThroughputHistory] = None,
+) -> None:
+    """Print the files an upload would act upon and an estimate of how long it would take"""
+    table = Table("status", "file", "size", "note")
+    for file in plan.queued:
+        table.add_row(
+            "[green]queued[/]",
+            str(file),
+            tqdm.format_sizeof(file.stat().st_size, "B", 1024),
+            "",
+        )
+    for file, reason in plan.skipped:
+        table.add_row("[yellow]skipped[/]", str(file), "", reason)
+    for file, reason in plan.invalid:
+        table.add_row("[red]invalid[/]", str(file), "", reason)
+    console.print(table)
+
+    total_bytes = plan.total_bytes
+    console.print(
+        f"{len(plan.queued)} file(s) queued, totalling "
+        f"[bold]{tqdm.format_sizeof(total_bytes, 'B', 1024)}[/]"
+    )
+
+    if history is None:
+        history = ThroughputHistory()
+    throughput, runs, exact = history.throughput(cytobank_domain, concurrency)
+    if throughput is None:
+        console.print(
+            f"No throughput history for {cytobank_domain}; unable to estimate the upload time"
+        )
+    else:
+        basis = (
+            f"with concurrency {concurrency}" if exact else "at any concurrency setting"
+        )
+        console.print(
+            f"Estimated time: [bold]{tqdm.format_interval(total_bytes / throughput)}[/] "
+            f"at {tqdm.format_sizeof(throughput, 'B/s', 1024)} "
+            f"(from {runs} previous upload(s) to {cytobank_domain} {basis})"
+        )
 
 
 @app.command(no_args_is_help=True)
@@ -93,6 +185,8 @@ def get_auth_token(
     version: Optional[bool] = typer.Option(
         None, "--version", callback=version_callback
     ),
+    profile_file: Optional[Path] = PROFILE_OPTION,
+    profile_sampling: Optional[float] = PROFILE_SAMPLING_OPTION,
 ) -> str:
     """Get an authorization token from Cytobank. Required for all operations.
     While the token will be stored to a configuration file, the tokens are only valid for 8 hrs.
@@ -125,14 +219,15 @@ def get_auth_token(
 
     """
 
-    token = _get_auth_token(
-        username=username,
-        password=password,
-        base_url=base_url,
-        auth_endpoint=auth_endpoint,
-        cytobank_domain=cytobank_domain,
-    )
-    return token
+    with profile(profile_file, profile_sampling, name="get-auth-token"):
+        token = _get_auth_token(
+            username=username,
+            password=password,
+            base_url=base_url,
+            auth_endpoint=auth_endpoint,
+            cytobank_domain=cytobank_domain,
+        )
+        return token
 
 
 @app.command(no_args_is_help=False)
@@ -149,7 +244,35 @@ def list_experiments(
     print_list: bool = typer.Option(
         True, "-p", "--print", help="print the last of experiments to the console"
     ),
+    output_format: str = typer.Option(
+        "text",
+        "--format",
+        help="Output format: text, ndjson, csv or json. Records are written as they are produced",
+    ),
+    fields: Optional[str] = typer.Option(
+        None,
+        "--fields",
+        help="Comma-separated list of the fields to include in ndjson, csv or json output",
+    ),
+    name: Optional[str] = typer.Option(
+        None,
+        "--name",
+        help="Only show experiments with a name matching this wildcard pattern, e.g. '*CD4*'",
+    ),
+    project: Optional[int] = typer.Option(
+        None, "--project", help="Only show experiments in the project with this id"
+    ),
+    since: Optional[datetime] = typer.Option(
+        None, "--since", help="Only show experiments created on or after this date"
+    ),
+    until: Optional[datetime] = typer.Option(
+        None,
+        "--until",
+        help="Only show experiments created on or before this date (a date without a time includes the whole day)",
+    ),
     verbose: bool = typer.Option(False, "-v", "--verbose"),
+    profile_file: Optional[Path] = PROFILE_OPTION,
+    profile_sampling: Optional[float] = PROFILE_SAMPLING_OPTION,
 ) -> list[Experiment]:
     """List the experiments associated with the account.  Will print in the form
     of `experimentName`: `experimentId`
@@ -164,48 +287,78 @@ def list_experiments(
     * **cytobank_domain** : str, optional
         Change the Cytobank domain. Required if you are using Cytobank Enterprise
 
-    ---
+    * **output_format** : str, optional
+        One of "text", "ndjson", "csv" or "json", by default "text"
 
-    *Returns*
+    * **fields** : Optional[str], optional
+        Comma-separated list of the fields to include, e.g. "id,experimentName".  By default, all fields
 
-    * **experiment_list** : list[Experiment]
-        A list of the current experiments, in the form of **experimentTitle**: **experimentId**
+    * **name** : Optional[str], optional
+        Only show experiments with a name matching this wildcard pattern (case-insensitive)
 
-    """
-    # TODO: add filtering options.  Grep/Ack/Ripgrep is fine, but do we want to rely on it?
-    logger.add(
-        f"{__name__}_{datetime.now().strftime('%d-%m-%Y--%H-%M-%S')}.log", level="DEBUG"
-    )
+    * **project** : Optional[int], optional
+        Only show experiments in the project with this id
 
-    if verbose:
-        logger.add(stderr, level="DEBUG")
-    else:
-        logger.add(stderr, level="ERROR")
+    * **since** : Optional[datetime], optional
+        Only show experiments created on or after this date
 
-    if auth_token is None:
-        auth_token = get_auth_token()
+    * **until** : Optional[datetime], optional
+        Only show experiments created on or before this date.  A date without a time
+        includes the whole of that day.
 
-    payload = {}
-    headers = {"Authorization": f"Bearer {auth_token}"}
+    ---
 
-    response = requests.get(
-        url=f"https://{cytobank_domain}.cytobank.org/cytobank/api/v1/experiments",
-        headers=headers,
-        data=payload,
-    )
+    *Returns*
 
-    if response.status_code == 200:
-        experiments_list = [
-            Experiment.from_dict(_) for _ in json.loads(response.text)["experiments"]
-        ]
-    else:
-        raise requests.HTTPError(f"HTTP error with code {response.status_code}")
+    * **experiment_list** : list[Experiment]
+        A list of the current experiments, in the form of **experimentTitle**: **experimentId**
 
-    if print_list:
-        for _ in experiments_list:
-            pprint(_)
+    """
+    with profile(profile_file, profile_sampling, name="list-experiments"):
+        logger.add(
+            f"{__name__}_{datetime.now().strftime('%d-%m-%Y--%H-%M-%S')}.log",
+            level="DEBUG",
+        )
 
-    return experiments_list
+        if verbose:
+            logger.add(stderr, level="DEBUG")
+        else:
+            logger.add(stderr, level="ERROR")
+
+        check_output_format(output_format)
+
+        auth_token = resolve_auth_token(auth_token, cytobank_domain)
+
+        experiments_list: list[Experiment] = []
+
+        # the API has no filtering parameters for this endpoint, so the experiments are
+        # filtered here as each one is parsed
+        def matching() -> Iterator[Experiment]:
+            for experiment in filter_records(
+                experiments_from_agent_or_api(cytobank_domain, auth_token),
+                name_field="experimentName",
+                name=name,
+                project=project,
+                since=since,
+                until=until,
+            ):
+                experiments_list.append(experiment)
+                yield experiment
+
+        if not print_list:
+            for _ in matching():
+                pass
+        elif output_format == "text":
+            for _ in matching():
+                pprint(_)
+        else:
+            write_records(
+                (_.to_dict() for _ in matching()),
+                output_format,
+                split_fields(fields),
+            )
+
+        return experiments_list
 
 
 @app.command(no_args_is_help=True)
@@ -220,7 +373,48 @@ def upload_files(
         help="Change the Cytobank domain. Required if you are using Cytobank Enterprise.",
     ),
     auth_token: Optional[str] = typer.Option(None, "-t", "--token"),
+    wait: bool = typer.Option(
+        False,
+        "-w",
+        "--wait",
+        help="After uploading, wait until Cytobank has ingested every file",
+    ),
+    wait_timeout: float = typer.Option(
+        600.0,
+        "--wait-timeout",
+        help="Maximum number of seconds to wait for ingest when using --wait",
+    ),
+    concurrency: int = typer.Option(
+        10,
+        "-c",
+        "--concurrency",
+        help="Maximum number of threads used to transfer each file",
+    ),
+    dry_run: bool = typer.Option(
+        False,
+        "-n",
+        "--dry-run",
+        help="Show which files would be uploaded and estimate how long it would take, without uploading",
+    ),
+    max_attempts: int = typer.Option(
+        5,
+        "-r",
+        "--retries",
+        help="Maximum number of times to try uploading each file",
+    ),
+    report_file: Optional[Path] = typer.Option(
+        None,
+        "--report",
+        help="Write the outcome of each file to this file as JSON",
+    ),
+    progress_mode: str = typer.Option(
+        "auto",
+        "--progress",
+        help="How to show progress: bar, text, json or none. 'auto' shows a bar in a terminal and text status lines otherwise",
+    ),
     verbose: bool = typer.Option(False, "-v", "--verbose"),
+    profile_file: Optional[Path] = PROFILE_OPTION,
+    profile_sampling: Optional[float] = PROFILE_SAMPLING_OPTION,
 ) -> None:
     """Upload one or more FCS files to a Cytobank project
 
@@ -242,37 +436,144 @@ def upload_files(
 
     * **auth_token** : Optional[str], optional
         _description_, by default typer.Option(None, "-t", "--token")
-    """
-    if verbose:
-        logger.add(stderr, level="DEBUG")
-    else:
-        logger.add(stderr, level="ERROR")
 
-    if auth_token is None:
-        auth_token = get_auth_token()
+    * **wait** : bool, optional
+        After uploading, poll the experiment until every file has been ingested.
+        Exits with a non-zero status if any file has not appeared before the timeout.
 
-    upload_token = get_upload_token(username, exp_id, cytobank_domain, auth_token)
-    logger.debug(upload_token)
+    * **wait_timeout** : float, optional
+        Maximum number of seconds to wait for ingest, by default 600
 
-    if not isinstance(files, list):
-        files = [files]
-    for _ in files:
-        if _.is_dir():
-            logger.debug(f"{_} is a dir")
-        elif _.is_file():
-            logger.debug(f"{_} is a file")
-        else:
-            logger.debug(f"I don't know what {_} is")
+    * **concurrency** : int, optional
+        Maximum number of threads used to transfer each file, by default 10
 
-    filelist = unpack([list(_.glob("*.fcs")) if _.is_dir() else _ for _ in files])
+    * **dry_run** : bool, optional
+        Resolve the files that would be uploaded and estimate the time the upload would take
+        from previous runs, without contacting Cytobank or transferring anything
 
-    _upload_files(
-        files=filelist,
-        username=username,
-        exp_id=exp_id,
-        cytobank_domain=cytobank_domain,
-        auth_token=auth_token,
-    )
+    * **max_attempts** : int, optional
+        Maximum number of times to try uploading each file, by default 5.  Only failures
+        that are likely to be temporary, such as a dropped connection, are retried.
+
+    * **report_file** : Optional[Path], optional
+        Write the outcome of each file (uploaded, skipped or failed) to this file as
+        JSON, listing the files that failed so that they can be queued again
+
+    * **progress_mode** : str, optional
+        One of "auto", "bar", "text", "json" or "none", by default "auto".  A single bar
+        for the whole upload is shown in a terminal; otherwise a status line is printed
+        every 30 seconds, which is better suited to the log of a cluster job.  Passing
+        "bar", "text" or "json" uploads from this process even if an agent is running,
+        since the agent cannot show progress.
+    """
+    with profile(profile_file, profile_sampling, name="upload-files"):
+        if verbose:
+            logger.add(stderr, level="DEBUG")
+        else:
+            logger.add(stderr, level="ERROR")
+
+        if not isinstance(files, list):
+            files = [files]
+
+        if progress_mode not in PROGRESS_MODES:
+            raise typer.BadParameter(
+                f"must be one of {', '.join(PROGRESS_MODES)}", param_hint="--progress"
+            )
+
+        plan = plan_upload(files)
+
+        if dry_run:
+            print_upload_plan(plan, cytobank_domain, concurrency)
+            return None
+
+        outcomes = [
+            UploadOutcome(path, "failed", 0, reason, transient=False)
+            for path, reason in plan.invalid
+        ] + [UploadOutcome(path, "skipped", 0, reason) for path, reason in plan.skipped]
+        for path, reason in plan.invalid:
+            logger.error(f"{path}: {reason}")
+        for path, reason in plan.skipped:
+            logger.warning(f"skipping {path}: {reason}")
+
+        auth_token = resolve_auth_token(auth_token, cytobank_domain)
+
+        existing_ids = None
+        if wait:
+            # files that are uploaded again keep their old records, so only the records
+            # added after this point show that a file has been ingested
+            existing_ids = _get_experiment_fcs_file_ids(
+                experimentId=exp_id,
+                cytobank_domain=cytobank_domain,
+                auth_token=auth_token,
+            )
+
+        # an upload handed to the agent runs in another process, which cannot show its
+        # progress here, so the agent is only used if no display was asked for
+        agent_outcomes = None
+        if progress_mode in ("auto", "none") and agent.agent_running():
+            if progress_mode == "auto":
+                console.print(
+                    "Uploading through the agent, which does not show progress; "
+                    "pass --progress to upload from here instead"
+                )
+            try:
+                agent_outcomes = call_agent(
+                    "upload_files",
+                    files=[str(_.resolve()) for _ in plan.queued],
+                    username=username,
+                    exp_id=exp_id,
+                    cytobank_domain=cytobank_domain,
+                    auth_token=auth_token,
+                    concurrency=concurrency,
+                    max_attempts=max_attempts,
+                )
+            except AgentUnavailable:
+                pass
+
+        if agent_outcomes is not None:
+            outcomes += [UploadOutcome.from_dict(_) for _ in agent_outcomes]
+        else:
+            outcomes += _upload_files(
+                files=plan.queued,
+                username=username,
+                exp_id=exp_id,
+                cytobank_domain=cytobank_domain,
+                auth_token=auth_token,
+                concurrency=concurrency,
+                max_attempts=max_attempts,
+                progress=TransferProgress(mode=progress_mode),
+            )
+
+        if report_file is not None:
+            write_report(outcomes, report_file)
+
+        uploaded = [_.file for _ in outcomes if _.status == "uploaded"]
+        failed = [_ for _ in outcomes if _.status == "failed"]
+        if failed:
+            console.print(f"[red]{len(failed)} file(s) could not be uploaded:[/]")
+            for _ in failed:
+                console.print(f"  {_}")
+
+        if wait and uploaded:
+            stalled = _wait_for_ingest(
+                files=uploaded,
+                exp_id=exp_id,
+                cytobank_domain=cytobank_domain,
+                auth_token=auth_token,
+                timeout=wait_timeout,
+                existing_ids=existing_ids,
+            )
+            if stalled:
+                console.print(
+                    f"[red]{len(stalled)} file(s) were not ingested within {wait_timeout} seconds:[/]"
+                )
+                for _ in stalled:
+                    console.print(f"  {_}")
+                raise typer.Exit(code=1)
+            console.print(f"[green]All {len(uploaded)} file(s) have been ingested[/]")
+
+        if failed:
+            raise typer.Exit(code=1)
 
 
 @app.command(no_args_is_help=True)
@@ -290,7 +591,32 @@ def show_experiment_files(
     auth_token: Optional[str] = typer.Option(
         None, "-t", "--token", help="Manually provide the authorization token"
     ),
+    output_format: str = typer.Option(
+        "text",
+        "--format",
+        help="Output format: text, ndjson, csv or json. Records are written as they are produced",
+    ),
+    fields: Optional[str] = typer.Option(
+        None,
+        "--fields",
+        help="Comma-separated list of the fields to include in ndjson, csv or json output",
+    ),
+    name: Optional[str] = typer.Option(
+        None,
+        "--name",
+        help="Only show files with a filename matching this wildcard pattern, e.g. '*CD4*'",
+    ),
+    since: Optional[datetime] = typer.Option(
+        None, "--since", help="Only show files uploaded on or after this date"
+    ),
+    until: Optional[datetime] = typer.Option(
+        None,
+        "--until",
+        help="Only show files uploaded on or before this date (a date without a time includes the whole day)",
+    ),
     verbose: bool = typer.Option(False, "-v", "--verbose"),
+    profile_file: Optional[Path] = PROFILE_OPTION,
+    profile_sampling: Optional[float] = PROFILE_SAMPLING_OPTION,
 ) -> None:
     """Prints a list the FCS files associated with the given experiment
 
@@ -307,19 +633,247 @@ def show_experiment_files(
     * **auth_token** : Optional[str], optional
         Manually provide the authorization token
 
+    * **output_format** : str, optional
+        One of "text", "ndjson", "csv" or "json", by default "text", which prints only the filenames
+
+    * **fields** : Optional[str], optional
+        Comma-separated list of the fields to include, e.g. "id,filename".  By default, all fields
+
+    * **name** : Optional[str], optional
+        Only show files with a filename matching this wildcard pattern (case-insensitive)
+
+    * **since** : Optional[datetime], optional
+        Only show files uploaded on or after this date
+
+    * **until** : Optional[datetime], optional
+        Only show files uploaded on or before this date.  A date without a time
+        includes the whole of that day.
+
     * **verbose** : bool, optional
     """
 
+    with profile(profile_file, profile_sampling, name="show-experiment-files"):
+        if verbose:
+            logger.add(stderr, level="DEBUG")
+        else:
+            logger.add(stderr, level="ERROR")
+
+        check_output_format(output_format)
+
+        auth_token = resolve_auth_token(auth_token, cytobank_domain)
+
+        try:
+            fcs_files_info = call_agent(
+                "list_fcs_files",
+                timeout=REQUEST_TIMEOUT,
+                experimentId=expid,
+                cytobank_domain=cytobank_domain,
+                auth_token=auth_token,
+            )
+        except AgentUnavailable:
+            if not test_token(auth_token, cytobank_domain):
+                raise InvalidTokenError(auth_token)
+            fcs_files_info = _get_experiment_fcs_files_info(
+                experimentId=expid,
+                cytobank_domain=cytobank_domain,
+                auth_token=auth_token,
+            )
+
+        fcs_files = filter_records(
+            fcs_files_info,
+            name_field="filename",
+            name=name,
+            since=since,
+            until=until,
+        )
+
+        if output_format == "text":
+            for _ in fcs_files:
+                print(_["filename"])
+        else:
+            write_records(fcs_files, output_format, split_fields(fields))
+
+
+@app.command(no_args_is_help=True)
+def download_files(
+    expid: int = typer.Argument(
+        ...,
+        help="Id for the experiment in question. Can be found using list_experiments()",
+    ),
+    output_dir: Optional[Path] = typer.Option(
+        None,
+        "-o",
+        "--output",
+        help="Directory in which to place the downloaded files. By default, the current directory",
+    ),
+    cytobank_domain: str = typer.Option(
+        "premium",
+        "-d",
+        "--domain",
+        help="Change the Cytobank domain. Required if you are using Cytobank Enterprise.",
+    ),
+    auth_token: Optional[str] = typer.Option(
+        None, "-t", "--token", help="Manually provide the authorization token"
+    ),
+    connections: int = typer.Option(
+        4, "-c", "--connections", help="Number of files to download at once"
+    ),
+    parts: int = typer.Option(
+        4,
+        "-n",
+        "--parts",
+        help="Number of simultaneous ranged requests to use for each file",
+    ),
+    max_attempts: int = typer.Option(
+        5,
+        "-r",
+        "--retries",
+        help="Maximum number of times to try downloading each file",
+    ),
+    verbose: bool = typer.Option(False, "-v", "--verbose"),
+    profile_file: Optional[Path] = PROFILE_OPTION,
+    profile_sampling: Optional[float] = PROFILE_SAMPLING_OPTION,
+) -> None:
+    """Download the FCS files associated with the given experiment, mirroring them
+    into a local directory.  Files already present with a matching size and checksum
+    are skipped and interrupted downloads are resumed.  Files for which Cytobank gives
+    no checksum are compared by size alone, and reported as "skipped (size only)".
+    Exits with a non-zero status if any file could not be downloaded.
+
+    ---
+
+    *Parameters*
+
+    * **expid** : int
+        Id for the experiment in question. Can be found using `list_experiments()`
+
+    * **output_dir** : Optional[Path], optional
+        Directory in which to place the downloaded files, by default the current directory
+
+    * **cytobank_domain** : str, optional
+        Change the Cytobank domain. Required if you are using Cytobank Enterprise.
+
+    * **auth_token** : Optional[str], optional
+        Manually provide the authorization token
+
+    * **connections** : int, optional
+        Number of files to download at once, by default 4
+
+    * **parts** : int, optional
+        Number of simultaneous ranged requests to use for each file, by default 4
+
+    * **max_attempts** : int, optional
+        Maximum number of times to try downloading each file, by default 5.  Only failures
+        that are likely to be temporary, such as a dropped connection, are retried.
+
+    * **verbose** : bool, optional
+    """
+
+    with profile(profile_file, profile_sampling, name="download-files"):
+        if verbose:
+            logger.add(stderr, level="DEBUG")
+        else:
+            logger.add(stderr, level="ERROR")
+
+        auth_token = resolve_auth_token(auth_token, cytobank_domain)
+
+        results = _download_experiment_files(
+            experimentId=expid,
+            output_dir=output_dir if output_dir is not None else Path.cwd(),
+            cytobank_domain=cytobank_domain,
+            auth_token=auth_token,
+            connections=connections,
+            parts=parts,
+            max_attempts=max_attempts,
+        )
+
+        for filename, status in results.items():
+            console.print(f"{status}: {filename}")
+
+        if failed := [_ for _, status in results.items() if status == "failed"]:
+            console.print(f"[red]{len(failed)} file(s) could not be downloaded[/]")
+            raise typer.Exit(code=1)
+
+
+agent_app = typer.Typer(
+    help="Manage a background agent that keeps sessions and tokens warm between commands. While it is running, other commands hand off to it automatically; set CYTOBANK_NO_AGENT=1 to prevent that.",
+    rich_markup_mode="markdown",
+)
+app.add_typer(agent_app, name="agent")
+
+
+@agent_app.command("start")
+def agent_start(
+    verbose: bool = typer.Option(False, "-v", "--verbose"),
+    profile_file: Optional[Path] = PROFILE_OPTION,
+    profile_sampling: Optional[float] = PROFILE_SAMPLING_OPTION,
+) -> None:
+    """Start the agent in the background"""
     if verbose:
         logger.add(stderr, level="DEBUG")
     else:
         logger.add(stderr, level="ERROR")
 
-    if auth_token is None:
-        auth_token = get_auth_token()
+    with profile(profile_file, profile_sampling, name="agent-start"):
+        if agent.agent_running():
+            console.print(f"An agent is already running on {agent.agent_socket()}")
+            return None
+        pid = agent.start()
+        console.print(
+            f"Agent started with pid {pid}, listening on {agent.agent_socket()}"
+        )
+
 
-    fcs_files = _list_experiment_fcs_files(
-        experimentId=expid, cytobank_domain=cytobank_domain, auth_token=auth_token
-    )
+@agent_app.command("serve")
+def agent_serve(
+    verbose: bool = typer.Option(False, "-v", "--verbose"),
+    profile_file: Optional[Path] = PROFILE_OPTION,
+    profile_sampling: Optional[float] = PROFILE_SAMPLING_OPTION,
+) -> None:
+    """Run the agent in the foreground.  When profiling, the profile covers everything
+    the agent does until it is stopped.  The agent handles each request in its own
+    thread, which cProfile cannot see, so stacks are always sampled (every 10ms
+    unless `--profile-sampling` says otherwise)."""
+    if verbose:
+        logger.add(stderr, level="DEBUG")
+    else:
+        logger.add(stderr, level="ERROR")
+
+    if profile_sampling is None:
+        profile_sampling = DEFAULT_SAMPLE_INTERVAL
+
+    with profile(profile_file, profile_sampling, name="agent-serve"):
+        agent.serve()
 
-    print("\n".join(fcs_files))
+
+@agent_app.command("stop")
+def agent_stop(
+    profile_file: Optional[Path] = PROFILE_OPTION,
+    profile_sampling: Optional[float] = PROFILE_SAMPLING_OPTION,
+) -> None:
+    """Stop a running agent"""
+    with profile(profile_file, profile_sampling, name="agent-stop"):
+        try:
+            call_agent("shutdown", timeout=5.0)
+        except AgentUnavailable:
+            console.print("No agent is running")
+            raise typer.Exit(code=1)
+        console.print("Agent stopped")
+
+
+@agent_app.command("status")
+def agent_status(
+    profile_file: Optional[Path] = PROFILE_OPTION,
+    profile_sampling: Optional[float] = PROFILE_SAMPLING_OPTION,
+) -> None:
+    """Show whether an agent is running"""
+    with profile(profile_file, profile_sampling, name="agent-status"):
+        try:
+            status = call_agent("ping", timeout=5.0)
+        except AgentUnavailable:
+            console.print("No agent is running")
+            raise typer.Exit(code=1)
+        console.print(
+            f"Agent running with pid {status['pid']} on {agent.agent_socket()}, "
+            f"up for {tqdm.format_interval(status['uptime'])}"
+        )
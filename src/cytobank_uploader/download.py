@@ -0,0 +1,320 @@
+import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from pathlib import Path
+from threading import Lock
+from typing import Any, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+from .interface import (
+    InvalidTokenError,
+    _get_auth_token,
+    _get_experiment_fcs_files_info,
+    test_token,
+)
+from .profiling import phase
+from .retry import RetryQueue, is_transient
+
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+STREAM_BLOCK_SIZE = 1024 * 1024
+
+
+@phase("hashing")
+def _md5sum(file: Path) -> str:
+    """Calculate the md5 checksum of a file, reading it in blocks"""
+    digest = md5()
+    with file.open("rb") as f:
+        for block in iter(lambda: f.read(STREAM_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _is_mirrored(
+    destination: Path, size: Optional[int], checksum: Optional[str]
+) -> bool:
+    """Check whether a local file already matches the copy on Cytobank.  At least
+    one of the size or checksum must be known for the file to be considered mirrored.
+    """
+    if not destination.is_file() or (size is None and checksum is None):
+        return False
+    if size is not None and destination.stat().st_size != size:
+        return False
+    if checksum is not None and _md5sum(destination) != checksum:
+        return False
+    return True
+
+
+def _probe_download(
+    session: requests.Session, url: str, headers: dict[str, str]
+) -> Tuple[str, Optional[int], bool]:
+    """Request the first byte of a download to find the final (post-redirect) url,
+    the total size, and whether the server will honor ranged requests.
+    """
+    with session.get(
+        url, headers={**headers, "Range": "bytes=0-0"}, stream=True
+    ) as response:
+        if response.status_code == 206:
+            total = int(response.headers["Content-Range"].rsplit("/", 1)[1])
+            return response.url, total, True
+        elif response.status_code == 200:
+            length = response.headers.get("Content-Length")
+            return response.url, int(length) if length is not None else None, False
+        else:
+            raise requests.HTTPError(
+                f"HTTP error with code {response.status_code}", response=response
+            )
+
+
+def _fetch_range(
+    session: requests.Session,
+    url: str,
+    headers: dict[str, str],
+    part_file: Path,
+    start: int,
+    end: int,
+) -> None:
+    """Download bytes `start` through `end` (inclusive) into their place in `part_file`"""
+    with session.get(
+        url, headers={**headers, "Range": f"bytes={start}-{end}"}, stream=True
+    ) as response:
+        if response.status_code != 206:
+            raise requests.HTTPError(
+                f"HTTP error with code {response.status_code}", response=response
+            )
+        with part_file.open("r+b") as f:
+            f.seek(start)
+            for block in response.iter_content(STREAM_BLOCK_SIZE):
+                f.write(block)
+
+
+def _download_fcs_file(
+    session: requests.Session,
+    record: dict[str, Any],
+    experimentId: int,
+    output_dir: Path,
+    cytobank_domain: str,
+    auth_token: str,
+    parts: int = 4,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> str:
+    """Download a single FCS file, resuming a previous partial download if one exists.
+
+    Files that support ranged requests are split into `chunk_size` pieces that are
+    fetched over `parts` simultaneous connections.  Finished chunks are recorded in a
+    `.part.json` file next to the partial download so that an interrupted download
+    only needs to fetch the missing pieces.
+
+    Returns
+    -------
+    str
+        "downloaded", "skipped" if a copy with a matching checksum (and size, if it is
+        known) was already present, or "skipped (size only)" if Cytobank gave no
+        checksum for the file and only the size of the local copy could be compared
+    """
+
+    destination = output_dir / Path(record["filename"]).name
+    checksum: Optional[str] = record.get("md5sum")
+    size: Optional[int] = record.get("fileSize")
+
+    if _is_mirrored(destination, size, checksum):
+        logger.debug(f"{destination} already mirrored, skipping")
+        return "skipped" if checksum is not None else "skipped (size only)"
+
+    base_url = f"https://{cytobank_domain}.cytobank.org/cytobank/api/v1"
+    url = f"{base_url}/experiments/{experimentId}/fcs_files/{record['id']}/download"
+    headers = {"Authorization": f"Bearer {auth_token}"}
+
+    resolved_url, total, ranged = _probe_download(session, url, headers)
+    # requests drops the Authorization header when redirected to another host (i.e.
+    # a presigned s3 url), and it must not be sent there when requested directly either
+    if urlparse(resolved_url).netloc != urlparse(url).netloc:
+        headers = {}
+    logger.debug(f"{destination.name}: {total=} {ranged=} {resolved_url=}")
+
+    part_file = destination.with_name(f"{destination.name}.part")
+    state_file = destination.with_name(f"{destination.name}.part.json")
+
+    with phase("transfer"):
+        if ranged and total is not None:
+            state = {"size": total, "chunk_size": chunk_size, "done": []}
+            if part_file.exists() and state_file.exists():
+                previous = json.loads(state_file.read_text())
+                if (previous["size"], previous["chunk_size"]) == (total, chunk_size):
+                    state = previous
+                    logger.debug(
+                        f"resuming {destination.name} with {len(state['done'])} chunk(s) done"
+                    )
+            if not state["done"]:
+                with part_file.open("wb") as f:
+                    f.truncate(total)
+
+            state_lock = Lock()
+
+            def fetch_chunk(start: int) -> None:
+                _fetch_range(
+                    session,
+                    resolved_url,
+                    headers,
+                    part_file,
+                    start,
+                    min(start + chunk_size, total) - 1,
+                )
+                with state_lock:
+                    state["done"].append(start)
+                    state_file.write_text(json.dumps(state))
+
+            done = set(state["done"])
+            pending = [_ for _ in range(0, total, chunk_size) if _ not in done]
+            with ThreadPoolExecutor(max_workers=max(1, parts)) as pool:
+                # list() so that an exception in any chunk is raised here
+                list(pool.map(fetch_chunk, pending))
+        else:
+            with session.get(resolved_url, headers=headers, stream=True) as response:
+                if response.status_code != 200:
+                    raise requests.HTTPError(
+                        f"HTTP error with code {response.status_code}",
+                        response=response,
+                    )
+                with part_file.open("wb") as f:
+                    for block in response.iter_content(STREAM_BLOCK_SIZE):
+                        f.write(block)
+
+    expected_size = size if size is not None else total
+    downloaded_size = part_file.stat().st_size
+    if expected_size is not None and downloaded_size != expected_size:
+        part_file.unlink()
+        state_file.unlink(missing_ok=True)
+        raise ValueError(
+            f"downloaded file {destination.name} is {downloaded_size} bytes, expected {expected_size}"
+        )
+    if checksum is not None and _md5sum(part_file) != checksum:
+        part_file.unlink()
+        state_file.unlink(missing_ok=True)
+        raise ValueError(f"checksum mismatch for downloaded file {destination.name}")
+
+    part_file.replace(destination)
+    state_file.unlink(missing_ok=True)
+    return "downloaded"
+
+
+def _download_experiment_files(
+    experimentId: int,
+    output_dir: Path,
+    cytobank_domain: str = "premium",
+    auth_token: Optional[str] = None,
+    connections: int = 4,
+    parts: int = 4,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_attempts: int = 5,
+) -> dict[str, str]:
+    """Download or mirror the FCS files of an experiment to a local directory.
+
+    A failure to download one file does not stop the others.  Files that fail with a
+    transient error are tried again after a jittered exponential backoff, resuming
+    from the chunks that were already fetched.
+
+    Parameters
+    ----------
+    experimentId : int
+        The experiment ID
+    output_dir : Path
+        Directory in which to place the files.  Created if it does not exist.
+    cytobank_domain : str, optional
+        The domain from "{domain}.cytobank.org" used to login. Defaults to "premium"
+    auth_token : Optional[str], optional
+        Cytobank API authorization token
+    connections : int, optional
+        Number of files to download at the same time.  By default 4
+    parts : int, optional
+        Number of simultaneous ranged requests used for each file.  By default 4
+    chunk_size : int, optional
+        Size, in bytes, of each ranged request.  By default 16 MiB
+    max_attempts : int, optional
+        Maximum number of times to try downloading each file, by default 5
+
+    Returns
+    -------
+    dict[str, str]
+        The outcome for each file: "downloaded", "skipped" if a copy with a matching
+        size and checksum was already present in `output_dir` ("skipped (size only)"
+        if Cytobank gave no checksum to compare), "failed", or
+        "duplicate" if the experiment holds more than one file with that name, in
+        which case none of them are downloaded
+    """
+
+    if auth_token is None:
+        auth_token = _get_auth_token()
+    elif not test_token(auth_token, cytobank_domain):
+        raise InvalidTokenError(auth_token)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    with requests.Session() as session:
+        adapter = HTTPAdapter(pool_maxsize=max(1, connections * parts))
+        session.mount("https://", adapter)
+
+        fcs_files_info = _get_experiment_fcs_files_info(
+            experimentId=experimentId,
+            cytobank_domain=cytobank_domain,
+            auth_token=auth_token,
+            session=session,
+        )
+        logger.debug(f"{len(fcs_files_info)} file(s) in experiment {experimentId}")
+
+        # files with the same name would be written to the same place, so which one
+        # ends up there cannot be decided here
+        names = Counter(Path(_["filename"]).name for _ in fcs_files_info)
+        results = {name: "duplicate" for name, n in names.items() if n > 1}
+        for name in results:
+            logger.error(
+                f"{names[name]} files in experiment {experimentId} are named {name}; "
+                "not downloading any of them"
+            )
+
+        def download(record: dict[str, Any]) -> Tuple[str, str]:
+            name = Path(record["filename"]).name
+            queue = RetryQueue([record], max_attempts=max_attempts)
+            for _, attempt in queue:
+                try:
+                    status = _download_fcs_file(
+                        session=session,
+                        record=record,
+                        experimentId=experimentId,
+                        output_dir=output_dir,
+                        cytobank_domain=cytobank_domain,
+                        auth_token=auth_token,
+                        parts=parts,
+                        chunk_size=chunk_size,
+                    )
+                except Exception as e:
+                    if (
+                        is_transient(e)
+                        and (delay := queue.retry(record, attempt)) is not None
+                    ):
+                        logger.warning(
+                            f"attempt {attempt} to download {name} failed ({e}), retrying in {delay:.1f}s"
+                        )
+                        continue
+                    logger.error(f"unable to download {name}: {e}")
+                    status = "failed"
+                logger.info(f"{name}: {status}")
+            return name, status
+
+        with ThreadPoolExecutor(max_workers=max(1, connections)) as pool:
+            results.update(
+                pool.map(
+                    download,
+                    [
+                        _
+                        for _ in fcs_files_info
+                        if Path(_["filename"]).name not in results
+                    ],
+                )
+            )
+
+    return results
@@ -88,6 +88,30 @@ class Experiment(object):
             f"publishedReportId: {self.publishedReportId}"
         )
 
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "version": self.version,
+            "purpose": self.purpose,
+            "comments": self.comments,
+            "public": self.public,
+            "deleted": self.deleted,
+            "sources": self.sources,
+            "experimentName": self.experimentName,
+            "gateVersion": self.gateVersion,
+            "createdAt": self.createdAt,
+            "updatedAt": self.updatedAt,
+            "primaryResearcherId": self.primaryResearcherId,
+            "principalInvestigatorId": self.principalInvestigatorId,
+            "uploaderId": self.uploaderId,
+            "projectId": self.projectId,
+            "clonedFrom": self.clonedFrom,
+            "createdFrom": self.createdFrom,
+            "childType": self.childType,
+            "createdFromUrl": self.createdFromUrl,
+            "publishedReportId": self.publishedReportId,
+        }
+
     @classmethod
     def from_dict(cls, source):
         exp = cls()
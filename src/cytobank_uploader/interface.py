@@ -1,15 +1,24 @@
 import json
 from datetime import datetime, timedelta
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Optional, Union
+from time import monotonic, sleep
+from typing import Any, Callable, Collection, Iterator, List, Optional, Set, Union
 from warnings import warn
 
 import requests
-from boto3 import client
 from loguru import logger
-from tqdm.auto import tqdm
 
 from .experiments import Experiment
+from .planner import ThroughputHistory
+from .profiling import phase
+from .progress import TransferProgress
+from .retry import RetryQueue, UploadOutcome, error_code, is_transient
+
+# how long a token that has been found to be valid is trusted before it is checked again
+TOKEN_RECHECK_SECONDS = 300.0
+
+_validated_tokens: dict[tuple[str, str], float] = {}
 
 
 class InvalidTokenError(Exception):
@@ -29,7 +38,13 @@ def test_token(
     token: str,
     domain: str = "premium",
 ) -> bool:
-    """Check to see if an authorization key is valid"""
+    """Check to see if an authorization key is valid.  A token found to be valid is
+    not checked again for `TOKEN_RECHECK_SECONDS`."""
+
+    if monotonic() - _validated_tokens.get((token, domain), -TOKEN_RECHECK_SECONDS) < (
+        TOKEN_RECHECK_SECONDS
+    ):
+        return True
 
     url = f"https://{domain}.cytobank.org/cytobank/api/v1/users"
 
@@ -37,9 +52,10 @@ def test_token(
     files = {}
     headers = {"Authorization": f"Bearer {token}"}
 
-    response = json.loads(
-        requests.get(url, headers=headers, data=payload, files=files).text
-    )
+    with phase("token probe"):
+        response = json.loads(
+            requests.get(url, headers=headers, data=payload, files=files).text
+        )
 
     # so, little weird but I cannot find any other calls one can make, other than retreiving
     # the list of experiments that will work without any other information, and that call
@@ -47,6 +63,7 @@ def test_token(
     # is invalid, it returns a different error than if it was valid.
     logger.debug(response["errors"][0])
     if response["errors"][0] == "Not Authorized To Access Resource":
+        _validated_tokens[(token, domain)] = monotonic()
         return True
     elif response["errors"][0] == "Not Authenticated -- invalid or missing auth token":
         return False
@@ -128,6 +145,7 @@ def set_auth_token(
     config_file.write_text(f"API_TOKEN={auth_token}\nRETRIEVE_TIME={datetime.now()}")
 
 
+@phase("auth")
 def _get_auth_token(
     username: Optional[str] = None,
     password: Optional[str] = None,
@@ -196,7 +214,9 @@ def _get_auth_token(
 
             return auth_token
         else:
-            raise requests.HTTPError(f"HTTP error with code {response.status_code}")
+            raise requests.HTTPError(
+                f"HTTP error with code {response.status_code}", response=response
+            )
 
 
 def get_experiment_id(title: str, exp_list: list[Experiment]) -> Union[int, None]:
@@ -226,6 +246,7 @@ def get_experiment_id(title: str, exp_list: list[Experiment]) -> Union[int, None
         return ident[0].id
 
 
+@phase("auth")
 def get_upload_token(
     username: str,
     exp_id: int,
@@ -277,21 +298,62 @@ def get_upload_token(
         logger.debug(f"{utr_parsed['accessKeyId']=}")
     else:
         raise requests.HTTPError(
-            f"HTTP error with code {upload_token_response.status_code}"
+            f"HTTP error with code {upload_token_response.status_code}",
+            response=upload_token_response,
         )
 
     return utr_parsed
 
 
+@lru_cache(maxsize=8)
+def _cached_s3_client(
+    access_key_id: str, secret_access_key: str, session_token: str
+) -> Any:
+    # boto3 takes a noticeable fraction of a second to import, so it is only imported
+    # once something is actually going to be uploaded
+    from boto3 import client
+
+    return client(
+        "s3",
+        aws_access_key_id=access_key_id,
+        aws_secret_access_key=secret_access_key,
+        aws_session_token=session_token,
+    )
+
+
+def _s3_client(upload_token: dict[str, Union[str, int, bool, float]]) -> Any:
+    """Get an s3 client for the upload credentials, reusing an existing client if one
+    was already made for them"""
+    return _cached_s3_client(
+        str(upload_token["accessKeyId"]),
+        str(upload_token["secretAccessKey"]),
+        str(upload_token["sessionToken"]),
+    )
+
+
 def _upload_files(
     files: list[Path],
     username: str,
     exp_id: int,
     cytobank_domain: str,
     auth_token: Optional[str],
-) -> None:
+    concurrency: int = 10,
+    history: Optional[ThroughputHistory] = None,
+    max_attempts: int = 5,
+    progress: Optional[TransferProgress] = None,
+    upload_token: Optional[dict[str, Union[str, int, bool, float]]] = None,
+    on_upload_token: Optional[
+        Callable[[Optional[dict[str, Union[str, int, bool, float]]]], None]
+    ] = None,
+) -> List[UploadOutcome]:
     """Upload one or more FCS files to a Cytobank project
 
+    A failure to upload one file does not stop the others.  Files that fail with a
+    transient error (dropped connections, timeouts, throttling, server errors) are put
+    back in the queue and retried after a jittered exponential backoff while the
+    remaining files continue to upload; files that fail with a permanent error (e.g.
+    the file is missing) are not retried.
+
     Parameters
     ----------
     files : list[Path], optional
@@ -304,6 +366,28 @@ def _upload_files(
         _description_, by default typer.Option("premium", "-d", "--domain")
     auth_token : Optional[str], optional
         _description_, by default typer.Option(None, "-t", "--token")
+    concurrency : int, optional
+        Maximum number of threads used to transfer each file, by default 10
+    history : Optional[ThroughputHistory], optional
+        Where to record the throughput of this upload for later time estimates.  By
+        default, the history file in the user's home directory is used.
+    max_attempts : int, optional
+        Maximum number of times to try uploading each file, by default 5
+    progress : Optional[TransferProgress], optional
+        Display for the progress of the upload.  By default, a bar is shown if stdout
+        is a terminal and periodic status lines are printed if not.
+    upload_token : Optional[dict[str, Union[str, int, bool, float]]], optional
+        Upload credentials previously retrieved with `get_upload_token()`.  By default,
+        new credentials are requested.
+    on_upload_token : Optional[Callable], optional
+        Called with the new upload credentials whenever expired ones are replaced, or
+        with None if they expired and could not be replaced, so that a caller that
+        keeps the credentials can update its copy
+
+    Returns
+    -------
+    List[UploadOutcome]
+        The outcome for each file, in the order in which they finished
     """
 
     if auth_token is None:
@@ -311,48 +395,160 @@ def _upload_files(
     elif not test_token(auth_token):
         raise InvalidTokenError(auth_token)
 
-    upload_token = get_upload_token(username, exp_id, cytobank_domain, auth_token)
+    from boto3.s3.transfer import TransferConfig
+
+    if history is None:
+        history = ThroughputHistory()
+    transfer_config = TransferConfig(max_concurrency=concurrency)
+
+    if upload_token is None:
+        upload_token = get_upload_token(username, exp_id, cytobank_domain, auth_token)
     logger.debug(upload_token)
 
-    s3_client = client(
-        "s3",
-        aws_access_key_id=upload_token["accessKeyId"],
-        aws_secret_access_key=upload_token["secretAccessKey"],
-        aws_session_token=upload_token["sessionToken"],
-    )
+    s3_client = _s3_client(upload_token)
 
+    uploaded_bytes = 0
+    transfer_seconds = 0.0
+    outcomes: List[UploadOutcome] = []
+    queue = RetryQueue(files, max_attempts=max_attempts)
+
+    if progress is None:
+        progress = TransferProgress()
     for file in files:
-        if file.exists():
-            with tqdm(
-                total=file.stat().st_size,
-                desc=f"uploading {file.name} to s3://{upload_token['uploadBucketName']}",
-                bar_format="{percentage:.1f}%|{bar:25} | {rate_fmt} | {desc}",
-                unit="B",
-                unit_scale=True,
-                unit_divisor=1024,
-            ) as pbar:
-
-                s3_client.upload_file(
-                    Filename=str(file.resolve()),
-                    Bucket=upload_token["uploadBucketName"],
-                    Key=f"experiments/{upload_token['experimentId']}/{file.name}",
-                    Callback=pbar.update,
+        progress.add(str(file), file.stat().st_size if file.is_file() else 0)
+    logger.debug(f"uploading to s3://{upload_token['uploadBucketName']}")
+
+    with progress:
+        for file, attempt in queue:
+            key = str(file)
+            try:
+                if not file.is_file():
+                    raise FileNotFoundError(f"{file.resolve()} was not found")
+
+                start = monotonic()
+                with phase("transfer"):
+                    s3_client.upload_file(
+                        Filename=str(file.resolve()),
+                        Bucket=upload_token["uploadBucketName"],
+                        Key=f"experiments/{upload_token['experimentId']}/{file.name}",
+                        Callback=progress.track(key),
+                        Config=transfer_config,
+                    )
+                transfer_seconds += monotonic() - start
+                uploaded_bytes += file.stat().st_size
+                progress.finish(key)
+                outcomes.append(UploadOutcome(file, "uploaded", attempt))
+
+            except Exception as e:
+                transient = is_transient(e)
+                if transient and (delay := queue.retry(file, attempt)) is not None:
+                    progress.reset(key)
+                    logger.warning(
+                        f"attempt {attempt} to upload {file.name} failed ({e}), retrying in {delay:.1f}s"
+                    )
+                    if error_code(e) == "ExpiredToken":
+                        logger.debug(
+                            "upload credentials have expired, requesting new ones"
+                        )
+                        try:
+                            upload_token = get_upload_token(
+                                username, exp_id, cytobank_domain, auth_token
+                            )
+                            s3_client = _s3_client(upload_token)
+                        except Exception as refresh_error:
+                            # the file is already back in the queue, so it will be
+                            # tried again (and the refresh with it) after its backoff
+                            logger.warning(
+                                f"unable to refresh upload credentials: {refresh_error}"
+                            )
+                            if on_upload_token is not None:
+                                on_upload_token(None)
+                        else:
+                            if on_upload_token is not None:
+                                on_upload_token(upload_token)
+                    continue
+                logger.error(f"unable to upload {file}: {e}")
+                progress.finish(key, succeeded=False)
+                outcomes.append(
+                    UploadOutcome(file, "failed", attempt, str(e), transient)
                 )
 
-        else:
-            raise FileNotFoundError(f"{file.resolve} was not found")
+    history.record(cytobank_domain, concurrency, uploaded_bytes, transfer_seconds)
 
+    return outcomes
 
-def _list_experiment_fcs_files(
+
+def _get_experiments(
+    cytobank_domain: str = "premium",
+    auth_token: Optional[str] = None,
+    session: Optional[requests.Session] = None,
+) -> Iterator[Experiment]:
+    """Retrieve the experiments associated with the account.  Does not check the
+    validity of the authorization token; that is left to the caller.
+
+    Parameters
+    ----------
+    cytobank_domain : str, optional
+        The domain from "{domain}.cytobank.org" used to login. Defaults to "premium"
+    auth_token : Optional[str], optional
+        Cytobank API authorization token
+    session : Optional[requests.Session], optional
+        An existing session to reuse for the request
+
+    Yields
+    ------
+    Experiment
+        Each experiment, as it is parsed from the response
+    """
+
+    payload = {}
+    headers = {"Authorization": f"Bearer {auth_token}"}
+
+    with phase("listing"):
+        response = (session if session is not None else requests).get(
+            url=f"https://{cytobank_domain}.cytobank.org/cytobank/api/v1/experiments",
+            headers=headers,
+            data=payload,
+        )
+
+        if response.status_code != 200:
+            raise requests.HTTPError(
+                f"HTTP error with code {response.status_code}", response=response
+            )
+
+        experiments = response.json()["experiments"]
+
+    for _ in experiments:
+        yield Experiment.from_dict(_)
+
+
+@phase("listing")
+def _get_experiment_fcs_files_info(
     experimentId: int,
     cytobank_domain: str = "premium",
     auth_token: Optional[str] = None,
-) -> List[str]:
+    session: Optional[requests.Session] = None,
+) -> List[dict[str, Any]]:
+    """Retrieve the full FCS file records for an experiment.  Does not check the
+    validity of the authorization token; that is left to the caller.
 
-    if auth_token is None:
-        auth_token = _get_auth_token()
-    elif not test_token(auth_token):
-        raise InvalidTokenError(auth_token)
+    Parameters
+    ----------
+    experimentId : int
+        The experiment ID
+    cytobank_domain : str, optional
+        The domain from "{domain}.cytobank.org" used to login. Defaults to "premium"
+    auth_token : Optional[str], optional
+        Cytobank API authorization token
+    session : Optional[requests.Session], optional
+        An existing session to reuse for the request, so that repeated calls can share
+        a connection.  By default, a new connection is made for each call.
+
+    Returns
+    -------
+    List[dict[str, Any]]
+        The `fcsFiles` records returned by the API
+    """
 
     headers = {"Authorization": f"Bearer {auth_token}"}
     payload = {}
@@ -360,18 +556,164 @@ def _list_experiment_fcs_files(
     base_url = f"https://{cytobank_domain}.cytobank.org/cytobank/api/v1"
     fcsfiles_endpoint = f"experiments/{experimentId}/fcs_files"
 
-    fcs_file_response = requests.get(
+    fcs_file_response = (session if session is not None else requests).get(
         url=f"{base_url}/{fcsfiles_endpoint}",
         headers=headers,
         data=payload,
     )
 
     if fcs_file_response.status_code == 200:
-        fcs_files_info = json.loads(fcs_file_response.text)
-        fcs_files = [_["filename"] for _ in fcs_files_info["fcsFiles"]]
+        fcs_files_info: List[dict[str, Any]] = json.loads(fcs_file_response.text)[
+            "fcsFiles"
+        ]
     else:
         raise requests.HTTPError(
-            f"HTTP error with code {fcs_file_response.status_code}"
+            f"HTTP error with code {fcs_file_response.status_code}",
+            response=fcs_file_response,
         )
 
+    return fcs_files_info
+
+
+def _list_experiment_fcs_files(
+    experimentId: int,
+    cytobank_domain: str = "premium",
+    auth_token: Optional[str] = None,
+) -> List[str]:
+
+    if auth_token is None:
+        auth_token = _get_auth_token()
+    elif not test_token(auth_token):
+        raise InvalidTokenError(auth_token)
+
+    fcs_files = [
+        _["filename"]
+        for _ in _get_experiment_fcs_files_info(
+            experimentId=experimentId,
+            cytobank_domain=cytobank_domain,
+            auth_token=auth_token,
+        )
+    ]
+
     return fcs_files
+
+
+def _get_experiment_fcs_file_ids(
+    experimentId: int,
+    cytobank_domain: str = "premium",
+    auth_token: Optional[str] = None,
+) -> Set[int]:
+    """Get the ids of the FCS file records currently in an experiment, so that the
+    records added by an upload can be told apart from those already there."""
+
+    if auth_token is None:
+        auth_token = _get_auth_token()
+    elif not test_token(auth_token, cytobank_domain):
+        raise InvalidTokenError(auth_token)
+
+    return {
+        _["id"]
+        for _ in _get_experiment_fcs_files_info(
+            experimentId=experimentId,
+            cytobank_domain=cytobank_domain,
+            auth_token=auth_token,
+        )
+    }
+
+
+@phase("ingest wait")
+def _wait_for_ingest(
+    files: List[Union[Path, str]],
+    exp_id: int,
+    cytobank_domain: str = "premium",
+    auth_token: Optional[str] = None,
+    timeout: float = 600.0,
+    initial_delay: float = 2.0,
+    max_delay: float = 60.0,
+    backoff_factor: float = 2.0,
+    existing_ids: Optional[Collection[int]] = None,
+) -> List[str]:
+    """Wait for Cytobank to finish ingesting uploaded files.
+
+    Files placed in the upload bucket are only listed in the experiment once Cytobank
+    has processed them.  All of the files are tracked together: each poll is a single
+    request for the experiment's FCS file listing over a shared session, and the delay
+    between polls grows exponentially up to `max_delay`.
+
+    A file that is uploaded again keeps its old record in the listing, so the ids of
+    the records present before the upload should be passed as `existing_ids`; only
+    records that are not among them count as ingested.  Transient errors while polling
+    are logged and the poll is tried again, while any other error (e.g. an experiment
+    that does not exist) is raised.
+
+    Parameters
+    ----------
+    files : List[Union[Path, str]]
+        The files that were uploaded.  Only the file names are used.
+    exp_id : int
+        The experiment ID the files were uploaded to
+    cytobank_domain : str, optional
+        The domain from "{domain}.cytobank.org" used to login. Defaults to "premium"
+    auth_token : Optional[str], optional
+        Cytobank API authorization token
+    timeout : float, optional
+        Maximum number of seconds to wait.  By default 600
+    initial_delay : float, optional
+        Seconds to wait before the second poll.  By default 2
+    max_delay : float, optional
+        Upper bound on the delay between polls.  By default 60
+    backoff_factor : float, optional
+        Multiplier applied to the delay after each unsuccessful poll.  By default 2
+    existing_ids : Optional[Collection[int]], optional
+        Ids of the FCS file records that were in the experiment before the upload,
+        from `_get_experiment_fcs_file_ids()`.  By default, any record with a matching
+        file name is taken to be the uploaded file.
+
+    Returns
+    -------
+    List[str]
+        Names of the files that did not appear in the experiment before the timeout.
+        Empty if every file was ingested.
+    """
+
+    if auth_token is None:
+        auth_token = _get_auth_token()
+    elif not test_token(auth_token, cytobank_domain):
+        raise InvalidTokenError(auth_token)
+
+    pending = {Path(_).name for _ in files}
+    existing = set(existing_ids) if existing_ids is not None else set()
+    deadline = monotonic() + timeout
+    delay = initial_delay
+
+    with requests.Session() as session:
+        while pending:
+            try:
+                listed = {
+                    _["filename"]
+                    for _ in _get_experiment_fcs_files_info(
+                        experimentId=exp_id,
+                        cytobank_domain=cytobank_domain,
+                        auth_token=auth_token,
+                        session=session,
+                    )
+                    if _["id"] not in existing
+                }
+            except requests.RequestException as e:
+                if not is_transient(e):
+                    raise
+                logger.warning(f"polling experiment {exp_id} failed: {e}")
+                listed = set()
+
+            for _ in sorted(pending & listed):
+                logger.info(f"{_} has been ingested")
+            pending -= listed
+            logger.debug(f"{len(pending)} file(s) still waiting on ingest")
+
+            remaining = deadline - monotonic()
+            if not pending or remaining <= 0:
+                break
+            sleep(min(delay, remaining))
+            delay = min(delay * backoff_factor, max_delay)
+
+    return sorted(pending)
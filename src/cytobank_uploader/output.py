@@ -0,0 +1,184 @@
+import csv
+import json
+import sys
+from datetime import datetime, time, timedelta, timezone
+from fnmatch import fnmatch
+from typing import Any, Iterable, Iterator, List, Optional, TextIO, TypeVar
+
+OUTPUT_FORMATS = ("text", "ndjson", "csv", "json")
+
+R = TypeVar("R")
+
+
+def _as_datetime(value: Any) -> Optional[datetime]:
+    """Parse a timestamp as a naive datetime in UTC, so that timestamps with and
+    without an offset can be compared.  Naive timestamps are taken to be in UTC."""
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        text = str(value)
+        if text.endswith("Z"):
+            text = f"{text[:-1]}+00:00"
+        try:
+            value = datetime.fromisoformat(text)
+        except ValueError:
+            return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _field(record: Any, field: str) -> Any:
+    """Get a field from either a dict or an object that supports item access, such as
+    an `Experiment`"""
+    try:
+        return record[field]
+    except (KeyError, AttributeError):
+        return None
+
+
+def _plain(value: Any) -> Any:
+    """Convert a value to something that can be written as JSON or CSV"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def filter_records(
+    records: Iterable[R],
+    name_field: str,
+    name: Optional[str] = None,
+    project: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    date_field: str = "createdAt",
+) -> Iterator[R]:
+    """Lazily filter records as they are produced
+
+    Parameters
+    ----------
+    records : Iterable[R]
+        The records to filter, either dicts or objects that support item access
+    name_field : str
+        The field matched against `name`
+    name : Optional[str], optional
+        A shell-style wildcard pattern (e.g. "*CD4*"), matched case-insensitively
+    project : Optional[int], optional
+        Only keep records with this `projectId`
+    since : Optional[datetime], optional
+        Only keep records created at or after this time
+    until : Optional[datetime], optional
+        Only keep records created at or before this time.  A time of midnight, which
+        is what a date given without a time becomes, keeps the whole of that day.
+    date_field : str, optional
+        The field compared against `since` and `until`, by default "createdAt".
+        Timestamps with an offset are converted to UTC; those without one are taken
+        to be in UTC already.
+
+    Yields
+    ------
+    R
+        The records that pass every filter
+    """
+    since = _as_datetime(since)
+    # records are kept up to, but not including, this time
+    before = None
+    if until is not None and until.time() == time.min:
+        before = _as_datetime(until + timedelta(days=1))
+        until = None
+    until = _as_datetime(until)
+    for record in records:
+        if name is not None and not fnmatch(
+            str(_field(record, name_field) or "").lower(), name.lower()
+        ):
+            continue
+        if project is not None and _field(record, "projectId") != project:
+            continue
+        if since is not None or until is not None or before is not None:
+            created = _as_datetime(_field(record, date_field))
+            if created is None:
+                continue
+            if since is not None and created < since:
+                continue
+            if until is not None and created > until:
+                continue
+            if before is not None and created >= before:
+                continue
+        yield record
+
+
+def write_records(
+    records: Iterable[dict[str, Any]],
+    output_format: str = "ndjson",
+    fields: Optional[List[str]] = None,
+    stream: Optional[TextIO] = None,
+) -> int:
+    """Write records to a stream as each one is produced, rather than after the whole
+    set has been collected.
+
+    Parameters
+    ----------
+    records : Iterable[dict[str, Any]]
+        The records to write
+    output_format : str, optional
+        One of "ndjson" (one JSON object per line), "csv" or "json" (a single array).
+        By default "ndjson"
+    fields : Optional[List[str]], optional
+        Only write these fields, in this order.  By default, all fields are written
+        (for csv, those of the first record)
+    stream : Optional[TextIO], optional
+        Where to write them, by default stdout
+
+    Returns
+    -------
+    int
+        The number of records written
+    """
+    if output_format not in OUTPUT_FORMATS[1:]:
+        raise ValueError(
+            f"output format must be one of {', '.join(OUTPUT_FORMATS[1:])}"
+        )
+
+    if stream is None:
+        stream = sys.stdout
+
+    writer: Optional[csv.DictWriter[str]] = None
+    written = 0
+
+    if output_format == "json":
+        stream.write("[")
+
+    for record in records:
+        if fields is not None:
+            record = {_: record.get(_) for _ in fields}
+        record = {k: _plain(v) for k, v in record.items()}
+
+        if output_format == "ndjson":
+            stream.write(f"{json.dumps(record)}\n")
+        elif output_format == "json":
+            stream.write(f"{',' if written else ''}\n  {json.dumps(record)}")
+        else:
+            if writer is None:
+                writer = csv.DictWriter(
+                    stream,
+                    fieldnames=list(record),
+                    extrasaction="ignore",
+                    lineterminator="\n",
+                )
+                writer.writeheader()
+            writer.writerow(record)
+        stream.flush()
+        written += 1
+
+    if output_format == "json":
+        stream.write("\n]\n" if written else "]\n")
+        stream.flush()
+
+    return written
+
+
+def split_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """Split a comma-separated list of field names"""
+    if fields is None:
+        return None
+    return [_.strip() for _ in fields.split(",") if _.strip()]
@@ -0,0 +1,164 @@
+import json
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Tuple
+
+from loguru import logger
+
+from .profiling import phase
+
+HISTORY_LENGTH = 20
+
+
+class UploadPlan(object):
+    """The set of files an upload would act upon, sorted into those that would be
+    uploaded (`queued`), those that would be left out because another file already
+    has the same name or because a directory holds no FCS files (`skipped`), and those
+    that cannot be uploaded (`invalid`).
+    """
+
+    def __init__(self):
+        self.queued: list[Path] = []
+        self.skipped: list[Tuple[Path, str]] = []
+        self.invalid: list[Tuple[Path, str]] = []
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(_.stat().st_size for _ in self.queued)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __str__(self):
+        return (
+            f"{len(self.queued)} queued, {len(self.skipped)} skipped, "
+            f"{len(self.invalid)} invalid"
+        )
+
+
+@phase("discovery")
+def plan_upload(files: list[Path]) -> UploadPlan:
+    """Resolve the files and directories passed for upload, without transferring
+    anything.  Directories are searched for FCS files.
+
+    Parameters
+    ----------
+    files : list[Path]
+        Files and/or directories containing FCS files
+
+    Returns
+    -------
+    UploadPlan
+    """
+    plan = UploadPlan()
+    seen: dict[str, Path] = {}
+
+    for path in files:
+        if path.is_dir():
+            found = sorted(path.glob("*.fcs"))
+            logger.debug(f"{path} is a dir with {len(found)} FCS files")
+            if not found:
+                plan.skipped.append((path, "directory contains no FCS files"))
+        elif path.is_file():
+            logger.debug(f"{path} is a file")
+            found = [path]
+        else:
+            logger.debug(f"I don't know what {path} is")
+            plan.invalid.append((path, "not found"))
+            found = []
+
+        for file in found:
+            # files are placed in the bucket by name, so a second file with the same
+            # name would overwrite the first
+            if file.name in seen:
+                plan.skipped.append((file, f"same name as {seen[file.name]}"))
+            else:
+                seen[file.name] = file
+                plan.queued.append(file)
+
+    return plan
+
+
+class ThroughputHistory(object):
+    """Upload throughput from previous runs, kept per Cytobank domain and concurrency
+    setting in a small JSON file.
+
+    Parameters
+    ----------
+    history_file : Optional[Path], optional
+        Where to store the history.  By default, `.cytobankhistory` in the user's home directory
+    """
+
+    def __init__(self, history_file: Optional[Path] = None):
+        if history_file is None:
+            history_file = Path.home() / ".cytobankhistory"
+        self.history_file = history_file
+
+    @staticmethod
+    def _key(cytobank_domain: str, concurrency: int) -> str:
+        return f"{cytobank_domain}:{concurrency}"
+
+    def load(self) -> dict[str, list[dict[str, float]]]:
+        if not self.history_file.exists():
+            return {}
+        try:
+            history: dict[str, list[dict[str, float]]] = json.loads(
+                self.history_file.read_text()
+            )
+        except ValueError:
+            logger.warning(f"unable to parse {self.history_file}, ignoring it")
+            return {}
+        return history
+
+    def record(
+        self, cytobank_domain: str, concurrency: int, nbytes: int, seconds: float
+    ) -> None:
+        """Add a completed run to the history, keeping only the most recent runs"""
+        if nbytes <= 0 or seconds <= 0:
+            return
+        history = self.load()
+        runs = history.setdefault(self._key(cytobank_domain, concurrency), [])
+        runs.append(
+            {
+                "bytes": nbytes,
+                "seconds": seconds,
+                "time": datetime.now().timestamp(),
+            }
+        )
+        del runs[:-HISTORY_LENGTH]
+        logger.debug(
+            f"recording {nbytes} bytes in {seconds:.1f}s to {self.history_file}"
+        )
+        self.history_file.write_text(json.dumps(history))
+
+    def throughput(
+        self, cytobank_domain: str, concurrency: int
+    ) -> Tuple[Optional[float], int, bool]:
+        """Estimate throughput, in bytes per second, from previous runs.
+
+        Runs to the same domain with the same concurrency are used if there are any,
+        otherwise all runs to the domain are used.
+
+        Returns
+        -------
+        Tuple[Optional[float], int, bool]
+            The throughput (None if there is no history for the domain), the number of
+            runs it is based upon, and whether those runs used the same concurrency
+        """
+        history = self.load()
+        runs = history.get(self._key(cytobank_domain, concurrency), [])
+        exact = bool(runs)
+        if not exact:
+            runs = [
+                run
+                for key, domain_runs in history.items()
+                if key.rsplit(":", 1)[0] == cytobank_domain
+                for run in domain_runs
+            ]
+        if not runs:
+            return None, 0, False
+        return (
+            sum(_["bytes"] for _ in runs) / sum(_["seconds"] for _ in runs),
+            len(runs),
+            exact,
+        )
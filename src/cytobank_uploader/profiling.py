@@ -0,0 +1,214 @@
+"""Profiling hooks for the command line interface and the Python API.
+
+Wrapping work in `profile()` records a cProfile profile of the calling thread, an
+optional sampling profile of every thread, and the wall-clock time spent in each of
+the phases marked with `phase()` throughout the package (auth, token probe, listing,
+discovery, hashing, transfer).  Everything is written to a single JSON file.
+
+When no profile is active, `phase()` does nothing beyond checking a module global.
+"""
+import cProfile
+import json
+import pstats
+import sys
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from threading import Event, Lock, Thread, get_ident
+from time import perf_counter
+from typing import Any, Iterator, Optional, Tuple
+
+from loguru import logger
+
+TOP_FUNCTIONS = 50
+TOP_STACKS = 200
+# seconds between samples, for profiles that need to see every thread
+DEFAULT_SAMPLE_INTERVAL = 0.01
+
+_active: Optional["Profiler"] = None
+
+
+class Profiler(object):
+    """Collects a profile of some work.  Use through `profile()`.
+
+    Parameters
+    ----------
+    sample_interval : Optional[float], optional
+        If given, also sample the stacks of every thread at this interval, in seconds.
+        cProfile only sees the thread that started it, whereas sampling also covers
+        the threads used for transfers.
+    """
+
+    def __init__(self, sample_interval: Optional[float] = None):
+        self.sample_interval = sample_interval
+        self.phases: dict[str, dict[str, float]] = {}
+        # for each phase, how many threads are in it and when the first of them entered
+        self._open_phases: dict[str, Tuple[int, float]] = {}
+        self.samples: Counter[str] = Counter()
+        self.sample_count = 0
+        self._lock = Lock()
+        self._cprofile = cProfile.Profile()
+        self._stop = Event()
+        self._sampler: Optional[Thread] = None
+        self._started = perf_counter()
+        self._wall = 0.0
+
+    def enter_phase(self, name: str) -> float:
+        """Record that a thread has entered a phase.  Returns the time it entered."""
+        now = perf_counter()
+        with self._lock:
+            count, opened = self._open_phases.get(name, (0, now))
+            self._open_phases[name] = (count + 1, opened)
+        return now
+
+    def exit_phase(self, name: str, entered: float) -> None:
+        """Record that a thread has left a phase it entered at `entered`.
+
+        "seconds" is the wall-clock time during which at least one thread was in the
+        phase, whereas "thread_seconds" adds up the time spent by each thread, and so
+        exceeds the wall-clock time when the phase runs in several threads at once.
+        """
+        now = perf_counter()
+        with self._lock:
+            totals = self.phases.setdefault(
+                name, {"seconds": 0.0, "thread_seconds": 0.0, "calls": 0}
+            )
+            totals["thread_seconds"] += now - entered
+            totals["calls"] += 1
+            count, opened = self._open_phases.pop(name)
+            if count > 1:
+                self._open_phases[name] = (count - 1, opened)
+            else:
+                totals["seconds"] += now - opened
+
+    def start(self) -> None:
+        self._started = perf_counter()
+        if self.sample_interval:
+            self._sampler = Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+        self._cprofile.enable()
+
+    def stop(self) -> None:
+        self._cprofile.disable()
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self._wall = perf_counter() - self._started
+
+    def _sample(self) -> None:
+        own_thread = get_ident()
+        while not self._stop.wait(self.sample_interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})"
+                    )
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def to_dict(self, name: Optional[str] = None) -> dict[str, Any]:
+        stats = pstats.Stats(self._cprofile)
+        functions = sorted(
+            stats.stats.items(),
+            key=lambda _: _[1][3],
+            reverse=True,
+        )[:TOP_FUNCTIONS]
+        return {
+            "name": name,
+            "created": datetime.now().isoformat(),
+            "python": sys.version,
+            "argv": sys.argv,
+            "wall_seconds": self._wall,
+            "phases": self.phases,
+            "functions": [
+                {
+                    "function": f"{function} ({Path(filename).name}:{line})",
+                    "file": filename,
+                    "calls": calls,
+                    "primitive_calls": primitive_calls,
+                    "total_seconds": total,
+                    "cumulative_seconds": cumulative,
+                }
+                for (
+                    (filename, line, function),
+                    (primitive_calls, calls, total, cumulative, _),
+                ) in functions
+            ],
+            "sampling": {
+                "interval": self.sample_interval,
+                "samples": self.sample_count,
+                "stacks": dict(self.samples.most_common(TOP_STACKS)),
+            },
+        }
+
+
+@contextmanager
+def profile(
+    output: Optional[Path],
+    sample_interval: Optional[float] = None,
+    name: Optional[str] = None,
+) -> Iterator[Optional[Profiler]]:
+    """Profile the work done inside the block and write the results to `output` as JSON.
+
+    Does nothing if `output` is None, so that it can wrap code unconditionally.
+
+    Parameters
+    ----------
+    output : Optional[Path]
+        File to write the profile to
+    sample_interval : Optional[float], optional
+        Also sample every thread's stack at this interval, in seconds.  By default, only
+        cProfile is used.
+    name : Optional[str], optional
+        A label for what was profiled, such as the name of the command
+
+    Examples
+    --------
+    >>> with profile(Path("upload.profile.json")):  # doctest: +SKIP
+    ...     _upload_files(files, username, exp_id, "premium", auth_token)
+    """
+    global _active
+
+    if output is None:
+        yield None
+        return
+
+    if _active is not None:
+        logger.warning("a profile is already being recorded; not starting another")
+        yield None
+        return
+
+    profiler = Profiler(sample_interval)
+    _active = profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _active = None
+        output.write_text(json.dumps(profiler.to_dict(name), indent=2))
+        logger.info(f"profile written to {output}")
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Mark a block as belonging to a phase (e.g. "auth" or "transfer"), so that the
+    wall-clock time spent in it is reported by an active profile.  Phases may be
+    nested, in which case the time is counted towards each of them, and may run in
+    several threads at once, in which case overlapping time is only counted once.
+    """
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+    entered = profiler.enter_phase(name)
+    try:
+        yield
+    finally:
+        profiler.exit_phase(name, entered)
@@ -0,0 +1,279 @@
+import json
+import sys
+from math import exp
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Any, Callable, Optional, TextIO
+
+from rich.console import Console, Group
+from rich.live import Live
+from rich.progress_bar import ProgressBar
+from rich.table import Table
+from tqdm import tqdm
+
+PROGRESS_MODES = ("auto", "bar", "text", "json", "none")
+
+# time constant, in seconds, used to smooth the transfer rate
+RATE_SMOOTHING = 5.0
+
+
+class _FileState(object):
+    def __init__(self, size: int):
+        self.size = size
+        self.done = 0
+        self.recent = 0
+        self.finished = False
+        self.failed = False
+
+
+class TransferProgress(object):
+    """Progress display for many simultaneous transfers.
+
+    The callbacks handed out by `track` are called from the transfer threads for every
+    block that is read (boto3 reads 8 KiB at a time), so all they do is add to the
+    byte counter of their file.  Memory use depends only on the number of files, not
+    on the number of callbacks.  A single background thread reads the counters and
+    redraws at a fixed, low rate: an overall bar and the most active files when
+    attached to a terminal, or periodic plain-text or JSON status lines otherwise (e.g.
+    in the log of a cluster job).  In the "none" mode nothing is recorded at all.
+
+    Parameters
+    ----------
+    mode : str, optional
+        One of "auto", "bar", "text", "json" or "none".  "auto" uses "bar" if stdout is
+        a terminal and "text" if not.  By default "auto"
+    refresh_per_second : float, optional
+        How often to redraw the bar, by default 4
+    status_interval : float, optional
+        Seconds between status lines in the "text" and "json" modes, by default 30
+    top_n : int, optional
+        Number of active files to show beneath the overall bar, by default 5
+    stream : Optional[TextIO], optional
+        Where to write the status lines, by default stdout
+    """
+
+    def __init__(
+        self,
+        mode: str = "auto",
+        refresh_per_second: float = 4.0,
+        status_interval: float = 30.0,
+        top_n: int = 5,
+        stream: Optional[TextIO] = None,
+    ):
+        if mode not in PROGRESS_MODES:
+            raise ValueError(
+                f"progress mode must be one of {', '.join(PROGRESS_MODES)}"
+            )
+        self.stream = stream if stream is not None else sys.stdout
+        if mode == "auto":
+            mode = "bar" if self.stream.isatty() else "text"
+        self.mode = mode
+        self.interval = (
+            1 / refresh_per_second if mode == "bar" else max(status_interval, 0.1)
+        )
+        self.top_n = top_n
+
+        # guards the per-file state, which is updated from the transfer threads
+        self._lock = Lock()
+        self._files: dict[str, _FileState] = {}
+        self._started = monotonic()
+        self._last_tick = self._started
+        self._last_bytes = 0
+        self._rate = 0.0
+        self._stop = Event()
+        self._thread: Optional[Thread] = None
+        self._live: Optional[Live] = None
+
+    def __enter__(self) -> "TransferProgress":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.stop()
+
+    def _state(self, key: str) -> _FileState:
+        with self._lock:
+            return self._files.setdefault(key, _FileState(0))
+
+    def add(self, key: str, size: int) -> None:
+        """Register a transfer so that it counts towards the overall total"""
+        if self.mode == "none":
+            return
+        self._state(key).size = size
+
+    def track(self, key: str) -> Callable[[int], None]:
+        """Get the callback to pass to a transfer as it (re)starts"""
+        if self.mode == "none":
+            return _ignore
+
+        state = self._state(key)
+        lock = self._lock
+
+        def callback(nbytes: int) -> None:
+            with lock:
+                state.done += nbytes
+                state.recent += nbytes
+
+        return callback
+
+    def reset(self, key: str) -> None:
+        """Discard the bytes counted for a transfer that will be started over"""
+        if self.mode == "none":
+            return
+        state = self._state(key)
+        with self._lock:
+            state.done = 0
+
+    def finish(self, key: str, succeeded: bool = True) -> None:
+        """Mark a transfer as done.  Failed transfers no longer count towards the total."""
+        if self.mode == "none":
+            return
+        state = self._state(key)
+        with self._lock:
+            state.finished = True
+            if not succeeded:
+                state.failed = True
+                state.done = 0
+
+    def start(self) -> None:
+        self._started = self._last_tick = monotonic()
+        if self.mode == "none":
+            return
+        if self.mode == "bar":
+            self._live = Live(
+                self._render(),
+                console=Console(file=self.stream),
+                auto_refresh=False,
+                transient=False,
+            )
+            self._live.start()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        # one last update so that the final state is always shown
+        self._update_rate()
+        if self._live is not None:
+            self._live.update(self._render(), refresh=True)
+            self._live.stop()
+        elif self.mode in ("text", "json"):
+            self._emit()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._update_rate()
+            if self._live is not None:
+                self._live.update(self._render(), refresh=True)
+            else:
+                self._emit()
+
+    def _update_rate(self) -> None:
+        now = monotonic()
+        done = self.bytes_done
+        if (elapsed := now - self._last_tick) > 0:
+            current = max(done - self._last_bytes, 0) / elapsed
+            weight = 1 - exp(-elapsed / RATE_SMOOTHING)
+            self._rate += weight * (current - self._rate)
+        self._last_tick, self._last_bytes = now, done
+
+    @property
+    def bytes_done(self) -> int:
+        with self._lock:
+            return sum(_.done for _ in self._files.values())
+
+    @property
+    def bytes_total(self) -> int:
+        with self._lock:
+            return sum(_.size for _ in self._files.values() if not _.failed)
+
+    def status(self) -> dict[str, Any]:
+        with self._lock:
+            files = list(self._files.items())
+            states = [state for _, state in files]
+            done = sum(_.done for _ in states)
+            total = sum(_.size for _ in states if not _.failed)
+            failed = sum(_.failed for _ in states)
+            finished = sum(_.finished for _ in states)
+            # the files that transferred the most since the last status
+            active = sorted(
+                (
+                    (key, state.done, state.size, state.recent)
+                    for key, state in files
+                    if not state.finished and state.done > 0
+                ),
+                key=lambda _: _[3],
+                reverse=True,
+            )[: self.top_n]
+            for state in states:
+                state.recent = 0
+        return {
+            "files_done": finished - failed,
+            "files_failed": failed,
+            "files_total": len(files),
+            "bytes_done": done,
+            "bytes_total": total,
+            "rate": self._rate,
+            "eta": (total - done) / self._rate if self._rate > 0 else None,
+            "elapsed": monotonic() - self._started,
+            "active": [
+                {"file": key, "bytes_done": done, "bytes_total": size}
+                for key, done, size, _ in active
+            ],
+        }
+
+    def _emit(self) -> None:
+        status = self.status()
+        if self.mode == "json":
+            line = json.dumps(status)
+        else:
+            line = (
+                f"{status['files_done']}/{status['files_total']} files, "
+                f"{_sizeof(status['bytes_done'])}/{_sizeof(status['bytes_total'])}, "
+                f"{_sizeof(status['rate'])}/s, "
+                f"eta {_interval(status['eta'])}"
+            )
+            if status["files_failed"]:
+                line += f", {status['files_failed']} failed"
+        print(line, file=self.stream, flush=True)
+
+    def _render(self) -> Group:
+        status = self.status()
+        overall = Table.grid(padding=(0, 1))
+        overall.add_row(
+            ProgressBar(
+                total=max(status["bytes_total"], 1),
+                completed=status["bytes_done"],
+                width=40,
+            ),
+            f"{status['files_done']}/{status['files_total']} files",
+            f"{_sizeof(status['bytes_done'])}/{_sizeof(status['bytes_total'])}",
+            f"{_sizeof(status['rate'])}/s",
+            f"eta {_interval(status['eta'])}",
+        )
+        active = Table.grid(padding=(0, 1))
+        for _ in status["active"]:
+            active.add_row(
+                "  ",
+                ProgressBar(
+                    total=max(_["bytes_total"], 1), completed=_["bytes_done"], width=20
+                ),
+                _["file"],
+            )
+        return Group(overall, active)
+
+
+def _ignore(nbytes: int) -> None:
+    pass
+
+
+def _sizeof(nbytes: float) -> str:
+    return str(tqdm.format_sizeof(nbytes, "B", 1024))
+
+
+def _interval(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "?"
+    return str(tqdm.format_interval(seconds))
@@ -0,0 +1,215 @@
+import heapq
+import json
+import re
+from itertools import count
+from pathlib import Path
+from random import uniform
+from time import monotonic, sleep
+from typing import Generic, Iterator, List, Optional, Tuple, TypeVar
+
+import requests
+
+T = TypeVar("T")
+
+# S3/STS error codes that are worth trying again
+TRANSIENT_ERROR_CODES = {
+    "ExpiredToken",
+    "InternalError",
+    "RequestExpired",
+    "RequestTimeout",
+    "RequestTimeTooSkewed",
+    "ServiceUnavailable",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+}
+
+
+def error_code(error: BaseException) -> Optional[str]:
+    """Find the S3 error code for an error raised during an upload, if there is one"""
+    # imported here rather than at the top so that importing the package does not
+    # have to wait on boto3
+    from boto3.exceptions import S3UploadFailedError
+    from botocore.exceptions import ClientError
+
+    if isinstance(error, ClientError):
+        code: Optional[str] = error.response.get("Error", {}).get("Code")
+        return code
+    if isinstance(error, S3UploadFailedError):
+        # boto3 only keeps the message of the underlying ClientError, which reads
+        # "... An error occurred (ErrorCode) when calling the ..."
+        if match := re.search(r"An error occurred \((\w+)\)", str(error)):
+            return match.group(1)
+    return None
+
+
+def _http_status(error: BaseException) -> Optional[int]:
+    from botocore.exceptions import ClientError
+
+    if isinstance(error, ClientError):
+        status: Optional[int] = error.response.get("ResponseMetadata", {}).get(
+            "HTTPStatusCode"
+        )
+        return status
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code
+    return None
+
+
+def is_transient(error: BaseException) -> bool:
+    """Classify an error as transient (worth retrying) or permanent.
+
+    Network failures, timeouts, throttling and server-side (5xx) errors are transient.
+    Everything else, such as a missing file or a permissions error, is permanent.
+    """
+    from boto3.exceptions import S3UploadFailedError
+    from botocore.exceptions import ConnectionError as BotoConnectionError
+    from botocore.exceptions import HTTPClientError
+
+    if isinstance(
+        error,
+        (
+            BotoConnectionError,
+            HTTPClientError,
+            requests.ConnectionError,
+            requests.Timeout,
+            ConnectionError,
+            TimeoutError,
+        ),
+    ):
+        return True
+    if (code := error_code(error)) is not None:
+        return code in TRANSIENT_ERROR_CODES
+    if (status := _http_status(error)) is not None:
+        return status == 429 or status >= 500
+    # an S3UploadFailedError without a recognizable code is most often a dropped connection
+    return isinstance(error, S3UploadFailedError)
+
+
+class RetryQueue(Generic[T]):
+    """A queue of work items in which failed items can be put back to be tried again
+    after a jittered exponential backoff.  Items waiting out their backoff do not hold
+    up the rest of the queue; the queue only sleeps when nothing else is ready.
+
+    Iterating over the queue yields `(item, attempt)` pairs, with `attempt` starting at 1.
+
+    Parameters
+    ----------
+    items : List[T]
+        The initial work items
+    max_attempts : int, optional
+        Maximum number of times an item will be tried, by default 5
+    base_delay : float, optional
+        Backoff before the first retry, in seconds, by default 1
+    max_delay : float, optional
+        Upper bound on the backoff, in seconds, by default 60
+    """
+
+    def __init__(
+        self,
+        items: List[T],
+        max_attempts: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # the counter keeps items in insertion order when they are ready at the same
+        # time, and means the items themselves never need to be compared
+        self._order = count()
+        self._heap: List[Tuple[float, int, T, int]] = [
+            (0.0, next(self._order), item, 1) for item in items
+        ]
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def __iter__(self) -> Iterator[Tuple[T, int]]:
+        while self._heap:
+            ready_at, _, item, attempt = heapq.heappop(self._heap)
+            if (wait := ready_at - monotonic()) > 0:
+                sleep(wait)
+            yield item, attempt
+
+    def retry(self, item: T, attempt: int) -> Optional[float]:
+        """Put an item that failed on its `attempt`th try back into the queue.
+
+        Returns
+        -------
+        Optional[float]
+            The backoff before the item will be tried again, or None if the item has
+            used all of its attempts
+        """
+        if attempt >= self.max_attempts:
+            return None
+        delay = uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        heapq.heappush(
+            self._heap, (monotonic() + delay, next(self._order), item, attempt + 1)
+        )
+        return delay
+
+
+class UploadOutcome(object):
+    """The result of trying to upload a single file: "uploaded", "failed", or
+    "skipped" if it was left out of the upload (e.g. another file has the same name)"""
+
+    def __init__(
+        self,
+        file: Path,
+        status: str,
+        attempts: int,
+        error: Optional[str] = None,
+        transient: Optional[bool] = None,
+    ):
+        self.file = file
+        self.status = status
+        self.attempts = attempts
+        self.error = error
+        self.transient = transient
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __str__(self):
+        if self.error is None:
+            return f"{self.file}: {self.status}"
+        return f"{self.file}: {self.status} ({self.error})"
+
+    @classmethod
+    def from_dict(cls, source):
+        return cls(
+            file=Path(source["file"]),
+            status=source["status"],
+            attempts=source["attempts"],
+            error=source["error"],
+            transient=source["transient"],
+        )
+
+    def to_dict(self) -> dict[str, object]:
+        return {
+            "file": str(self.file),
+            "status": self.status,
+            "attempts": self.attempts,
+            "error": self.error,
+            "transient": self.transient,
+        }
+
+
+def write_report(outcomes: List[UploadOutcome], report_file: Path) -> None:
+    """Write the outcome of every file in an upload to a JSON file, so that the failed
+    files can be picked out and queued again.
+    """
+    failed = [_ for _ in outcomes if _.status == "failed"]
+    report_file.write_text(
+        json.dumps(
+            {
+                "uploaded": sum(_.status == "uploaded" for _ in outcomes),
+                "skipped": sum(_.status == "skipped" for _ in outcomes),
+                "failed": len(failed),
+                "failed_files": [str(_.file) for _ in failed],
+                "files": [_.to_dict() for _ in outcomes],
+            },
+            indent=2,
+        )
+    )
@@ -0,0 +1,236 @@
+import os
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from threading import Thread
+
+import pytest
+
+from cytobank_uploader import agent
+from cytobank_uploader.agent import (
+    UPLOAD_TOKEN_MARGIN,
+    UPLOAD_TOKEN_TTL,
+    Agent,
+    AgentError,
+    AgentServer,
+    AgentUnavailable,
+    call_agent,
+)
+from cytobank_uploader.interface import InvalidTokenError
+from cytobank_uploader.retry import UploadOutcome
+
+
+def upload_token(**fields):
+    return {"accessKeyId": "key", "sessionToken": "session", **fields}
+
+
+@pytest.fixture
+def issued(monkeypatch):
+    """Hand out a new set of upload credentials for every request, and record them"""
+    tokens = []
+
+    def get_upload_token(*args, **kwargs):
+        tokens.append(upload_token(sessionToken=f"session {len(tokens)}"))
+        return tokens[-1]
+
+    monkeypatch.setattr(agent, "get_upload_token", get_upload_token)
+    return tokens
+
+
+def test_dispatch_unknown_command():
+    response = Agent().dispatch({"command": "format_disk"})
+    assert response["ok"] is False
+    assert response["type"] == "ValueError"
+
+
+def test_dispatch_reports_the_type_of_an_error(monkeypatch):
+    def invalid(*args, **kwargs):
+        raise InvalidTokenError("token")
+
+    monkeypatch.setattr(agent, "test_token", invalid)
+    response = Agent().dispatch(
+        {"command": "list_fcs_files", "args": {"experimentId": 1, "auth_token": "x"}}
+    )
+    assert response["ok"] is False
+    assert response["type"] == "InvalidTokenError"
+
+
+def test_upload_token_deadline_uses_the_expiration():
+    in_an_hour = datetime.now(timezone.utc) + timedelta(hours=1)
+    now = agent.monotonic()
+    for expiration in (in_an_hour.isoformat(), in_an_hour.timestamp()):
+        deadline = agent._upload_token_deadline(upload_token(expiration=expiration))
+        assert deadline - now == pytest.approx(3600 - UPLOAD_TOKEN_MARGIN, abs=5)
+
+
+def test_upload_token_deadline_without_an_expiration():
+    now = agent.monotonic()
+    deadline = agent._upload_token_deadline(upload_token())
+    assert deadline - now == pytest.approx(UPLOAD_TOKEN_TTL, abs=5)
+
+
+def test_upload_tokens_are_reused_until_they_are_about_to_expire(issued):
+    running = Agent()
+    key = ("user", 1, "premium")
+    first = running._upload_token(*key, "auth")
+    assert running._upload_token(*key, "auth") is first
+    assert len(issued) == 1
+
+    # credentials that expire within the margin are replaced
+    soon = datetime.now(timezone.utc) + timedelta(seconds=UPLOAD_TOKEN_MARGIN / 2)
+    running._store_upload_token(key, upload_token(expiration=soon.isoformat()))
+    assert running._upload_token(*key, "auth") is issued[-1]
+    assert len(issued) == 2
+
+
+def test_upload_keeps_credentials_refreshed_during_the_upload(issued, monkeypatch):
+    refreshed = upload_token(sessionToken="refreshed")
+
+    def fake_upload(files, on_upload_token, upload_token, **kwargs):
+        assert upload_token is issued[0]
+        on_upload_token(refreshed)
+        return [UploadOutcome(Path(_), "uploaded", 2) for _ in files]
+
+    monkeypatch.setattr(agent, "test_token", lambda *args, **kwargs: True)
+    monkeypatch.setattr(agent, "_upload_files", fake_upload)
+
+    running = Agent()
+    outcomes = running.upload_files(["a.fcs"], "user", 1, auth_token="auth")
+    assert outcomes[0]["status"] == "uploaded"
+    assert running._upload_token("user", 1, "premium", "auth") is refreshed
+    assert len(issued) == 1
+
+
+def test_expired_credentials_that_could_not_be_refreshed_are_forgotten(issued):
+    running = Agent()
+    key = ("user", 1, "premium")
+    running._upload_token(*key, "auth")
+    running._store_upload_token(key, None)
+    running._upload_token(*key, "auth")
+    assert len(issued) == 2
+
+
+def test_call_agent_can_be_disabled(monkeypatch):
+    monkeypatch.setenv("CYTOBANK_NO_AGENT", "1")
+    with pytest.raises(AgentUnavailable):
+        call_agent("ping")
+
+
+def test_call_agent_without_an_agent(monkeypatch, tmp_path):
+    monkeypatch.delenv("CYTOBANK_NO_AGENT", raising=False)
+    monkeypatch.setenv("CYTOBANK_AGENT_SOCKET", str(tmp_path / "missing.sock"))
+    with pytest.raises(AgentUnavailable):
+        call_agent("ping")
+    assert not agent.agent_running()
+
+
+def test_socket_is_per_host_without_a_runtime_dir(monkeypatch):
+    monkeypatch.delenv("CYTOBANK_AGENT_SOCKET", raising=False)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", "/run/user/1000")
+    assert agent.agent_socket() == Path("/run/user/1000/cytobank-agent.sock")
+    monkeypatch.delenv("XDG_RUNTIME_DIR")
+    assert socket.gethostname() in agent.agent_socket().name
+
+
+@pytest.fixture
+def socket_dir(monkeypatch):
+    # socket paths are limited to ~100 characters, which pytest's tmp_path can exceed
+    directory = Path(tempfile.mkdtemp(prefix="cytobank-"))
+    monkeypatch.delenv("CYTOBANK_NO_AGENT", raising=False)
+    monkeypatch.setenv("CYTOBANK_AGENT_SOCKET", str(directory / "agent.sock"))
+    yield directory
+    for path in directory.iterdir():
+        path.unlink()
+    directory.rmdir()
+
+
+def test_call_agent_gives_up_on_an_agent_that_does_not_reply(socket_dir):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as hung:
+        hung.bind(str(socket_dir / "agent.sock"))
+        # connections are queued, but never accepted
+        hung.listen()
+        with pytest.raises(AgentUnavailable):
+            call_agent("ping", timeout=0.1)
+
+
+def test_call_agent_without_permission(socket_dir):
+    path = socket_dir / "agent.sock"
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as other:
+        other.bind(str(path))
+        other.listen()
+        path.chmod(0)
+        if os.access(path, os.W_OK):
+            pytest.skip("permissions are not enforced for this user")
+        with pytest.raises(AgentUnavailable):
+            call_agent("ping")
+
+
+def leftover_socket(path, owner):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(str(path))
+    if owner is not None:
+        agent._owner_file(path).write_text(owner)
+
+
+def test_socket_of_an_exited_agent_is_removed(socket_dir):
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    path = socket_dir / "agent.sock"
+    leftover_socket(path, f"{socket.gethostname()} {exited.pid}")
+    agent._remove_stale_socket(path)
+    assert not path.exists()
+    assert not agent._owner_file(path).exists()
+
+
+def test_socket_of_a_running_process_is_kept(socket_dir):
+    path = socket_dir / "agent.sock"
+    leftover_socket(path, f"{socket.gethostname()} {os.getpid()}")
+    with pytest.raises(AgentError):
+        agent._remove_stale_socket(path)
+    assert path.exists()
+
+
+@pytest.mark.parametrize("owner", [None, "other-node 1"])
+def test_socket_that_may_belong_to_another_host_is_kept(socket_dir, owner):
+    path = socket_dir / "agent.sock"
+    leftover_socket(path, owner)
+    with pytest.raises(AgentError):
+        agent._remove_stale_socket(path)
+    assert path.exists()
+
+
+@pytest.fixture
+def server(socket_dir):
+    with AgentServer(socket_dir / "agent.sock") as server:
+        thread = Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield server
+        server.shutdown()
+        thread.join()
+
+
+def test_socket_is_only_accessible_to_the_user(server):
+    assert stat.S_IMODE(server.path.stat().st_mode) & 0o077 == 0
+
+
+def test_requests_over_the_socket(server, monkeypatch):
+    assert agent.agent_running()
+    assert call_agent("ping")["pid"] > 0
+
+    with pytest.raises(AgentError):
+        call_agent("format_disk")
+
+    def invalid(*args, **kwargs):
+        raise InvalidTokenError("token")
+
+    monkeypatch.setattr(agent, "test_token", invalid)
+    with pytest.raises(InvalidTokenError):
+        call_agent("list_fcs_files", experimentId=1, auth_token="token")
+
+
+def test_shutdown_over_the_socket(server):
+    assert call_agent("shutdown") is None
@@ -0,0 +1,225 @@
+import json
+from hashlib import md5
+
+import pytest
+import requests
+
+from cytobank_uploader import download
+
+CONTENT = bytes(range(256)) * 40
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content=b"", headers=None, url=""):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.url = url
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return None
+
+    def iter_content(self, block_size):
+        for start in range(0, len(self.content), block_size):
+            yield self.content[start : start + block_size]
+
+
+class FakeSession(object):
+    """Serves `CONTENT` for every download, honoring ranged requests.  Requests for
+    the ranges in `fail_ranges` fail with a 503, once each."""
+
+    def __init__(self, fail_ranges=()):
+        self.fail_ranges = set(fail_ranges)
+        self.ranges = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return None
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def get(self, url, headers=None, stream=False):
+        byte_range = (headers or {}).get("Range")
+        if byte_range is None:
+            return FakeResponse(
+                200, CONTENT, {"Content-Length": str(len(CONTENT))}, url
+            )
+        self.ranges.append(byte_range)
+        if byte_range in self.fail_ranges:
+            self.fail_ranges.discard(byte_range)
+            return FakeResponse(503, url=url)
+        start, end = (int(_) for _ in byte_range.split("=")[1].split("-"))
+        return FakeResponse(
+            206,
+            CONTENT[start : end + 1],
+            {"Content-Range": f"bytes {start}-{end}/{len(CONTENT)}"},
+            url,
+        )
+
+
+def record(name="a.fcs", id=1, checksum=True):
+    return {
+        "id": id,
+        "filename": name,
+        "fileSize": len(CONTENT),
+        "md5sum": md5(CONTENT).hexdigest() if checksum else None,
+    }
+
+
+def download_file(session, tmp_path, **kwargs):
+    return download._download_fcs_file(
+        session=session,
+        record=record(),
+        experimentId=1,
+        output_dir=tmp_path,
+        cytobank_domain="premium",
+        auth_token="token",
+        parts=2,
+        chunk_size=1024,
+        **kwargs,
+    )
+
+
+def test_download_fetches_every_chunk(tmp_path):
+    session = FakeSession()
+    assert download_file(session, tmp_path) == "downloaded"
+    assert (tmp_path / "a.fcs").read_bytes() == CONTENT
+    assert not (tmp_path / "a.fcs.part").exists()
+    assert not (tmp_path / "a.fcs.part.json").exists()
+
+
+def test_download_skips_a_mirrored_file(tmp_path):
+    (tmp_path / "a.fcs").write_bytes(CONTENT)
+    session = FakeSession()
+    assert download_file(session, tmp_path) == "skipped"
+    assert session.ranges == []
+
+
+def test_download_resumes_from_the_finished_chunks(tmp_path):
+    part_file = tmp_path / "a.fcs.part"
+    part_file.write_bytes(CONTENT[:2048] + bytes(len(CONTENT) - 2048))
+    (tmp_path / "a.fcs.part.json").write_text(
+        json.dumps({"size": len(CONTENT), "chunk_size": 1024, "done": [0, 1024]})
+    )
+
+    session = FakeSession()
+    assert download_file(session, tmp_path) == "downloaded"
+    assert (tmp_path / "a.fcs").read_bytes() == CONTENT
+    # only the chunks that were not done are requested again
+    assert "bytes=0-1023" not in session.ranges
+    assert "bytes=1024-2047" not in session.ranges
+    assert "bytes=2048-3071" in session.ranges
+
+
+def test_download_rejects_a_checksum_mismatch(tmp_path):
+    session = FakeSession()
+    with pytest.raises(ValueError):
+        download._download_fcs_file(
+            session=session,
+            record={**record(), "md5sum": "0" * 32},
+            experimentId=1,
+            output_dir=tmp_path,
+            cytobank_domain="premium",
+            auth_token="token",
+            chunk_size=1024,
+        )
+    assert not (tmp_path / "a.fcs").exists()
+    assert not (tmp_path / "a.fcs.part").exists()
+
+
+@pytest.fixture
+def experiment(monkeypatch):
+    """Serve a canned experiment listing through a `FakeSession`"""
+    records = []
+    session = FakeSession()
+
+    monkeypatch.setattr(download, "test_token", lambda *args, **kwargs: True)
+    monkeypatch.setattr(
+        download, "_get_experiment_fcs_files_info", lambda **kwargs: records
+    )
+    monkeypatch.setattr(download.requests, "Session", lambda: session)
+    monkeypatch.setattr("cytobank_uploader.retry.sleep", lambda seconds: None)
+    return records, session
+
+
+def test_experiment_download_retries_transient_failures(tmp_path, experiment):
+    records, session = experiment
+    records.append(record())
+    session.fail_ranges = {"bytes=1024-2047"}
+
+    results = download._download_experiment_files(
+        1, tmp_path, auth_token="token", parts=2, chunk_size=1024
+    )
+    assert results == {"a.fcs": "downloaded"}
+    assert (tmp_path / "a.fcs").read_bytes() == CONTENT
+    assert session.ranges.count("bytes=1024-2047") == 2
+
+
+def test_experiment_download_reports_failures_without_stopping(
+    tmp_path, experiment, monkeypatch
+):
+    records, session = experiment
+    records.extend([record("a.fcs", 1), record("b.fcs", 2, checksum=False)])
+
+    original = download._download_fcs_file
+
+    def fail_a(**kwargs):
+        if kwargs["record"]["filename"] == "a.fcs":
+            response = requests.Response()
+            response.status_code = 403
+            raise requests.HTTPError("HTTP error with code 403", response=response)
+        return original(**kwargs)
+
+    monkeypatch.setattr(download, "_download_fcs_file", fail_a)
+
+    results = download._download_experiment_files(
+        1, tmp_path, auth_token="token", chunk_size=1024
+    )
+    assert results == {"a.fcs": "failed", "b.fcs": "downloaded"}
+
+
+def test_experiment_download_reports_duplicate_names(tmp_path, experiment):
+    records, session = experiment
+    records.extend([record("a.fcs", 1), record("a.fcs", 2), record("b.fcs", 3)])
+
+    results = download._download_experiment_files(
+        1, tmp_path, auth_token="token", chunk_size=1024
+    )
+    assert results == {"a.fcs": "duplicate", "b.fcs": "downloaded"}
+    assert not (tmp_path / "a.fcs").exists()
+
+
+def test_download_without_a_checksum_is_skipped_on_size_only(tmp_path):
+    (tmp_path / "a.fcs").write_bytes(CONTENT)
+    session = FakeSession()
+    status = download._download_fcs_file(
+        session=session,
+        record=record(checksum=False),
+        experimentId=1,
+        output_dir=tmp_path,
+        cytobank_domain="premium",
+        auth_token="token",
+    )
+    assert status == "skipped (size only)"
+
+
+def test_download_rejects_a_size_mismatch(tmp_path):
+    session = FakeSession()
+    with pytest.raises(ValueError, match="bytes, expected"):
+        download._download_fcs_file(
+            session=session,
+            record={**record(checksum=False), "fileSize": len(CONTENT) + 1},
+            experimentId=1,
+            output_dir=tmp_path,
+            cytobank_domain="premium",
+            auth_token="token",
+            chunk_size=1024,
+        )
+    assert not (tmp_path / "a.fcs").exists()
+    assert not (tmp_path / "a.fcs.part").exists()
@@ -0,0 +1,204 @@
+import json
+
+import pytest
+import requests
+from botocore.exceptions import ClientError
+
+from cytobank_uploader import interface
+from cytobank_uploader.planner import ThroughputHistory
+from cytobank_uploader.progress import TransferProgress
+
+
+@pytest.fixture
+def listings(monkeypatch):
+    """Replace the FCS file listing with a sequence of canned responses, one per poll.
+    A response that is an exception is raised instead of returned."""
+    responses = []
+
+    def fake_listing(**kwargs):
+        response = responses.pop(0) if len(responses) > 1 else responses[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(interface, "test_token", lambda *args, **kwargs: True)
+    monkeypatch.setattr(interface, "_get_experiment_fcs_files_info", fake_listing)
+    monkeypatch.setattr(interface, "sleep", lambda seconds: None)
+    return responses
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f"HTTP error with code {status}", response=response)
+
+
+def test_wait_for_ingest_returns_when_every_file_is_listed(listings):
+    listings.extend(
+        [
+            [],
+            [{"id": 1, "filename": "a.fcs"}],
+            [{"id": 1, "filename": "a.fcs"}, {"id": 2, "filename": "b.fcs"}],
+        ]
+    )
+    stalled = interface._wait_for_ingest(
+        ["dir/a.fcs", "dir/b.fcs"], exp_id=1, auth_token="token", timeout=60
+    )
+    assert stalled == []
+    assert len(listings) == 1
+
+
+def test_wait_for_ingest_ignores_records_that_existed_before_the_upload(listings):
+    listings.extend(
+        [
+            [{"id": 1, "filename": "a.fcs"}],
+            [{"id": 1, "filename": "a.fcs"}, {"id": 7, "filename": "a.fcs"}],
+        ]
+    )
+    stalled = interface._wait_for_ingest(
+        ["a.fcs"], exp_id=1, auth_token="token", timeout=60, existing_ids={1}
+    )
+    assert stalled == []
+    # the first poll only saw the old record, so a second poll was needed
+    assert len(listings) == 1
+
+
+def test_wait_for_ingest_reports_files_missing_at_the_timeout(listings):
+    listings.append([{"id": 1, "filename": "a.fcs"}])
+    stalled = interface._wait_for_ingest(
+        ["a.fcs", "b.fcs"], exp_id=1, auth_token="token", timeout=0
+    )
+    assert stalled == ["b.fcs"]
+
+
+def test_wait_for_ingest_retries_transient_errors(listings):
+    listings.extend([http_error(503), [{"id": 1, "filename": "a.fcs"}]])
+    assert (
+        interface._wait_for_ingest(["a.fcs"], exp_id=1, auth_token="token", timeout=60)
+        == []
+    )
+
+
+@pytest.mark.parametrize("status", [401, 404])
+def test_wait_for_ingest_raises_permanent_errors(listings, status):
+    listings.append(http_error(status))
+    with pytest.raises(requests.HTTPError):
+        interface._wait_for_ingest(["a.fcs"], exp_id=1, auth_token="token", timeout=60)
+
+
+class FakeS3Client(object):
+    """Records uploads, raising the errors queued for a file name first"""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.uploaded = []
+
+    def upload_file(self, Filename, Bucket, Key, Callback, Config):
+        name = Key.rsplit("/", 1)[1]
+        if self.errors.get(name):
+            raise self.errors[name].pop(0)
+        Callback(10)
+        self.uploaded.append(name)
+
+
+UPLOAD_TOKEN = {
+    "accessKeyId": "key",
+    "secretAccessKey": "secret",
+    "sessionToken": "session",
+    "uploadBucketName": "bucket",
+    "experimentId": 1,
+}
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    client = FakeS3Client()
+    monkeypatch.setattr(interface, "test_token", lambda *args, **kwargs: True)
+    monkeypatch.setattr(interface, "_s3_client", lambda upload_token: client)
+    monkeypatch.setattr(
+        interface, "get_upload_token", lambda *args, **kwargs: UPLOAD_TOKEN
+    )
+    monkeypatch.setattr("cytobank_uploader.retry.sleep", lambda seconds: None)
+    return client
+
+
+@pytest.fixture
+def fcs_files(tmp_path):
+    files = [tmp_path / "a.fcs", tmp_path / "b.fcs"]
+    for _ in files:
+        _.write_bytes(b"x" * 10)
+    return files
+
+
+def upload(files, tmp_path, **kwargs):
+    return interface._upload_files(
+        files=files,
+        username="user",
+        exp_id=1,
+        cytobank_domain="premium",
+        auth_token="token",
+        history=ThroughputHistory(tmp_path / "history.json"),
+        progress=TransferProgress(mode="none"),
+        **kwargs,
+    )
+
+
+def expired_token():
+    return ClientError({"Error": {"Code": "ExpiredToken"}}, "PutObject")
+
+
+def test_upload_retries_transient_failures(s3, fcs_files, tmp_path):
+    s3.errors = {"a.fcs": [requests.ConnectionError("connection reset")]}
+    outcomes = upload(fcs_files, tmp_path)
+    assert {(_.file.name, _.status, _.attempts) for _ in outcomes} == {
+        ("a.fcs", "uploaded", 2),
+        ("b.fcs", "uploaded", 1),
+    }
+
+
+def test_upload_does_not_retry_permanent_failures(s3, fcs_files, tmp_path):
+    missing = tmp_path / "missing.fcs"
+    outcomes = upload([missing, *fcs_files], tmp_path)
+    assert [(_.file.name, _.status, _.attempts) for _ in outcomes] == [
+        ("missing.fcs", "failed", 1),
+        ("a.fcs", "uploaded", 1),
+        ("b.fcs", "uploaded", 1),
+    ]
+
+
+def test_upload_refreshes_expired_credentials(s3, fcs_files, tmp_path, monkeypatch):
+    refreshed = []
+
+    def get_upload_token(*args, **kwargs):
+        refreshed.append(True)
+        return UPLOAD_TOKEN
+
+    monkeypatch.setattr(interface, "get_upload_token", get_upload_token)
+    s3.errors = {"a.fcs": [expired_token()]}
+    outcomes = upload(fcs_files, tmp_path, upload_token=UPLOAD_TOKEN)
+    assert all(_.status == "uploaded" for _ in outcomes)
+    assert len(refreshed) == 1
+
+
+@pytest.mark.parametrize(
+    "refresh_error",
+    [
+        interface.InvalidTokenError("token"),
+        json.JSONDecodeError("Expecting value", "<html>502</html>", 0),
+        KeyError("errors"),
+        requests.ConnectionError("connection reset"),
+    ],
+)
+def test_upload_survives_a_failed_credential_refresh(
+    s3, fcs_files, tmp_path, monkeypatch, refresh_error
+):
+    def get_upload_token(*args, **kwargs):
+        raise refresh_error
+
+    monkeypatch.setattr(interface, "get_upload_token", get_upload_token)
+    s3.errors = {"a.fcs": [expired_token(), expired_token()]}
+    outcomes = upload(fcs_files, tmp_path, upload_token=UPLOAD_TOKEN, max_attempts=2)
+    assert {(_.file.name, _.status) for _ in outcomes} == {
+        ("a.fcs", "failed"),
+        ("b.fcs", "uploaded"),
+    }
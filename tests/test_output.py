@@ -0,0 +1,108 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+import pytest
+
+from cytobank_uploader.experiments import Experiment
+from cytobank_uploader.output import filter_records, split_fields, write_records
+
+RECORDS = [
+    {"id": 1, "filename": "CD4_a.fcs", "createdAt": "2022-01-01T10:00:00Z"},
+    {"id": 2, "filename": "CD8_b.fcs", "createdAt": "2022-02-01T10:00:00+02:00"},
+    {"id": 3, "filename": "cd4_c.fcs", "createdAt": "2022-03-01T10:00:00"},
+    {"id": 4, "filename": "undated.fcs", "createdAt": None},
+]
+
+
+def ids(records):
+    return [_["id"] for _ in records]
+
+
+def test_filter_by_name_ignores_case():
+    assert ids(filter_records(RECORDS, "filename", name="*CD4*")) == [1, 3]
+
+
+def test_filter_by_date_with_and_without_offsets():
+    since = datetime(2022, 1, 15)
+    until = datetime(2022, 2, 1, 8, 0)
+    # 10:00+02:00 is 08:00 UTC, so the second record is on the boundary
+    assert ids(filter_records(RECORDS, "filename", since=since, until=until)) == [2]
+    assert ids(filter_records(RECORDS, "filename", since=since)) == [2, 3]
+
+
+def test_filter_until_a_date_includes_the_whole_day():
+    until = datetime(2022, 2, 1)
+    assert ids(filter_records(RECORDS, "filename", until=until)) == [1, 2]
+    assert ids(filter_records(RECORDS, "filename", until=datetime(2022, 1, 1))) == [1]
+
+
+def test_filter_by_date_with_an_aware_bound():
+    since = datetime.fromisoformat("2022-02-01T09:00:00+01:00")
+    assert ids(filter_records(RECORDS, "filename", since=since)) == [2, 3]
+
+
+def test_filter_by_project_on_objects():
+    experiments = [
+        Experiment(ident=1, experimentName="a", projectId=5),
+        Experiment(ident=2, experimentName="b", projectId=6),
+    ]
+    matched = list(filter_records(experiments, "experimentName", project=6))
+    assert [_.id for _ in matched] == [2]
+
+
+def test_filter_is_lazy():
+    def records():
+        yield RECORDS[0]
+        raise AssertionError("read past the first match")
+
+    assert next(filter_records(records(), "filename", name="*a.fcs"))["id"] == 1
+
+
+def test_write_ndjson():
+    stream = io.StringIO()
+    assert write_records(RECORDS[:2], "ndjson", ["id"], stream) == 2
+    assert [json.loads(_) for _ in stream.getvalue().splitlines()] == [
+        {"id": 1},
+        {"id": 2},
+    ]
+
+
+def test_write_json():
+    stream = io.StringIO()
+    write_records(RECORDS, "json", stream=stream)
+    assert json.loads(stream.getvalue()) == RECORDS
+
+
+def test_write_json_without_records():
+    stream = io.StringIO()
+    assert write_records([], "json", stream=stream) == 0
+    assert json.loads(stream.getvalue()) == []
+
+
+def test_write_csv_uses_the_fields_of_the_first_record():
+    stream = io.StringIO()
+    write_records(
+        [{"id": 1, "filename": "a.fcs"}, {"id": 2, "filename": "b.fcs", "x": 1}],
+        "csv",
+        stream=stream,
+    )
+    rows = list(csv.DictReader(io.StringIO(stream.getvalue())))
+    assert rows == [{"id": "1", "filename": "a.fcs"}, {"id": "2", "filename": "b.fcs"}]
+
+
+def test_write_converts_datetimes():
+    stream = io.StringIO()
+    write_records([{"createdAt": datetime(2022, 1, 1)}], "ndjson", stream=stream)
+    assert json.loads(stream.getvalue()) == {"createdAt": "2022-01-01T00:00:00"}
+
+
+def test_write_rejects_text():
+    with pytest.raises(ValueError):
+        write_records(RECORDS, "text")
+
+
+def test_split_fields():
+    assert split_fields(None) is None
+    assert split_fields(" id, filename ,,") == ["id", "filename"]
@@ -0,0 +1,82 @@
+from pathlib import Path
+
+import pytest
+
+from cytobank_uploader.planner import HISTORY_LENGTH, ThroughputHistory, plan_upload
+
+
+@pytest.fixture
+def fcs_dir(tmp_path):
+    for name in ("a.fcs", "b.fcs", "notes.txt"):
+        (tmp_path / name).write_bytes(b"x" * 10)
+    return tmp_path
+
+
+def test_plan_upload_expands_directories(fcs_dir):
+    plan = plan_upload([fcs_dir])
+    assert plan.queued == [fcs_dir / "a.fcs", fcs_dir / "b.fcs"]
+    assert plan.skipped == []
+    assert plan.invalid == []
+    assert plan.total_bytes == 20
+
+
+def test_plan_upload_skips_files_with_the_same_name(fcs_dir, tmp_path_factory):
+    other = tmp_path_factory.mktemp("other")
+    (other / "a.fcs").write_bytes(b"y")
+    plan = plan_upload([fcs_dir / "a.fcs", other / "a.fcs"])
+    assert plan.queued == [fcs_dir / "a.fcs"]
+    assert [_ for _, reason in plan.skipped] == [other / "a.fcs"]
+
+
+def test_plan_upload_skips_a_directory_without_fcs_files(tmp_path):
+    plan = plan_upload([tmp_path])
+    assert plan.queued == []
+    assert plan.invalid == []
+    assert plan.skipped == [(tmp_path, "directory contains no FCS files")]
+
+
+def test_plan_upload_marks_missing_files_invalid(tmp_path):
+    missing = tmp_path / "missing.fcs"
+    plan = plan_upload([missing])
+    assert plan.invalid == [(missing, "not found")]
+    assert str(plan) == "0 queued, 0 skipped, 1 invalid"
+
+
+@pytest.fixture
+def history(tmp_path):
+    return ThroughputHistory(tmp_path / "history.json")
+
+
+def test_history_without_runs(history):
+    assert history.throughput("premium", 10) == (None, 0, False)
+
+
+def test_history_uses_runs_with_the_same_concurrency(history):
+    history.record("premium", 10, 100, 1.0)
+    history.record("premium", 10, 300, 1.0)
+    history.record("premium", 2, 1, 1.0)
+    assert history.throughput("premium", 10) == (200.0, 2, True)
+
+
+def test_history_falls_back_to_any_concurrency(history):
+    history.record("premium", 2, 100, 1.0)
+    history.record("premium", 4, 300, 1.0)
+    history.record("other", 10, 1, 1.0)
+    assert history.throughput("premium", 10) == (200.0, 2, False)
+
+
+def test_history_keeps_only_recent_runs(history):
+    for _ in range(HISTORY_LENGTH + 5):
+        history.record("premium", 10, 100, 1.0)
+    assert len(history.load()["premium:10"]) == HISTORY_LENGTH
+
+
+def test_history_ignores_empty_runs(history):
+    history.record("premium", 10, 0, 1.0)
+    history.record("premium", 10, 100, 0.0)
+    assert history.load() == {}
+
+
+def test_history_ignores_an_unreadable_file(history):
+    Path(history.history_file).write_text("not json")
+    assert history.throughput("premium", 10) == (None, 0, False)
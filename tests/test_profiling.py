@@ -0,0 +1,106 @@
+import json
+from threading import Thread
+from time import sleep
+
+from cytobank_uploader import profiling
+from cytobank_uploader.profiling import phase, profile
+
+
+def busy(seconds):
+    sleep(seconds)
+
+
+def test_profile_without_output_does_nothing(tmp_path):
+    with profile(None) as profiler:
+        with phase("auth"):
+            pass
+    assert profiler is None
+    assert profiling._active is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_phase_outside_a_profile():
+    with phase("auth"):
+        pass
+
+    @phase("auth")
+    def decorated():
+        return 1
+
+    assert decorated() == 1
+
+
+def test_profile_records_functions_and_phases(tmp_path):
+    output = tmp_path / "profile.json"
+    with profile(output, name="test"):
+        with phase("auth"):
+            busy(0.01)
+        with phase("transfer"):
+            with phase("hashing"):
+                busy(0.01)
+        with phase("auth"):
+            pass
+
+    result = json.loads(output.read_text())
+    assert result["name"] == "test"
+    assert result["phases"]["auth"]["calls"] == 2
+    assert result["phases"]["transfer"]["seconds"] >= 0.01
+    # nested phases count towards both
+    assert result["phases"]["hashing"]["seconds"] >= 0.01
+    assert any(_["function"].startswith("busy ") for _ in result["functions"])
+    assert result["sampling"]["samples"] == 0
+    assert profiling._active is None
+
+
+def test_concurrent_phases_count_wall_time_once(tmp_path):
+    output = tmp_path / "profile.json"
+
+    def transfer():
+        with phase("transfer"):
+            busy(0.1)
+
+    with profile(output):
+        workers = [Thread(target=transfer) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    result = json.loads(output.read_text())
+    transfer_phase = result["phases"]["transfer"]
+    assert transfer_phase["calls"] == 4
+    assert transfer_phase["seconds"] <= result["wall_seconds"]
+    assert transfer_phase["thread_seconds"] >= 0.4
+
+
+def test_profile_samples_other_threads(tmp_path):
+    output = tmp_path / "profile.json"
+    with profile(output, sample_interval=0.001):
+        worker = Thread(target=busy, args=(0.1,))
+        worker.start()
+        worker.join()
+
+    sampling = json.loads(output.read_text())["sampling"]
+    assert sampling["samples"] > 0
+    assert any("busy (test_profiling.py" in _ for _ in sampling["stacks"])
+
+
+def test_nested_profiles_are_not_started(tmp_path):
+    with profile(tmp_path / "outer.json") as outer:
+        with profile(tmp_path / "inner.json") as inner:
+            pass
+    assert outer is not None
+    assert inner is None
+    assert not (tmp_path / "inner.json").exists()
+    assert (tmp_path / "outer.json").exists()
+
+
+def test_profile_is_written_when_the_work_fails(tmp_path):
+    output = tmp_path / "profile.json"
+    try:
+        with profile(output):
+            raise RuntimeError("failed")
+    except RuntimeError:
+        pass
+    assert output.exists()
+    assert profiling._active is None
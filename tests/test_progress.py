@@ -0,0 +1,95 @@
+import io
+import json
+
+import pytest
+
+from cytobank_uploader.progress import TransferProgress
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        TransferProgress(mode="fancy")
+
+
+def test_auto_uses_text_when_not_attached_to_a_terminal():
+    assert TransferProgress(stream=io.StringIO()).mode == "text"
+
+
+def quiet():
+    return TransferProgress(mode="text", status_interval=60, stream=io.StringIO())
+
+
+def test_status_counts_bytes_and_files():
+    progress = quiet()
+    with progress:
+        progress.add("a.fcs", 100)
+        progress.add("b.fcs", 50)
+        progress.add("c.fcs", 25)
+        progress.track("a.fcs")(60)
+        progress.track("a.fcs")(40)
+        progress.finish("a.fcs")
+        progress.track("b.fcs")(20)
+        progress.track("c.fcs")(10)
+        progress.finish("c.fcs", succeeded=False)
+    status = progress.status()
+    assert status["files_done"] == 1
+    assert status["files_failed"] == 1
+    assert status["files_total"] == 3
+    # the failed file no longer counts towards either total
+    assert status["bytes_done"] == 120
+    assert status["bytes_total"] == 150
+    assert [_["file"] for _ in status["active"]] == ["b.fcs"]
+
+
+def test_reset_discards_the_bytes_of_a_retried_transfer():
+    progress = quiet()
+    with progress:
+        progress.add("a.fcs", 100)
+        progress.track("a.fcs")(70)
+        progress.reset("a.fcs")
+        progress.track("a.fcs")(100)
+        progress.finish("a.fcs")
+    assert progress.status()["bytes_done"] == 100
+
+
+def test_callbacks_only_keep_a_counter_per_file():
+    progress = quiet()
+    with progress:
+        progress.add("a.fcs", 8192 * 10_000)
+        callback = progress.track("a.fcs")
+        for _ in range(10_000):
+            callback(8192)
+        assert len(progress._files) == 1
+    assert progress.status()["bytes_done"] == 8192 * 10_000
+
+
+def test_none_mode_records_nothing():
+    progress = TransferProgress(mode="none")
+    with progress:
+        progress.add("a.fcs", 100)
+        progress.track("a.fcs")(100)
+        progress.finish("a.fcs")
+    assert progress.status()["files_total"] == 0
+    assert progress.bytes_done == 0
+
+
+def test_json_mode_writes_a_final_status_line():
+    stream = io.StringIO()
+    with TransferProgress(mode="json", status_interval=60, stream=stream) as progress:
+        progress.add("a.fcs", 100)
+        progress.track("a.fcs")(100)
+        progress.finish("a.fcs")
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 1
+    status = json.loads(lines[0])
+    assert status["files_done"] == 1
+    assert status["bytes_done"] == status["bytes_total"] == 100
+
+
+def test_text_mode_reports_failures():
+    stream = io.StringIO()
+    with TransferProgress(mode="text", status_interval=60, stream=stream) as progress:
+        progress.add("a.fcs", 100)
+        progress.finish("a.fcs", succeeded=False)
+    assert stream.getvalue().startswith("0/1 files")
+    assert stream.getvalue().rstrip().endswith("1 failed")
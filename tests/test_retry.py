@@ -0,0 +1,157 @@
+import json
+from pathlib import Path
+
+import pytest
+import requests
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from cytobank_uploader import retry
+from cytobank_uploader.retry import (
+    RetryQueue,
+    UploadOutcome,
+    error_code,
+    is_transient,
+    write_report,
+)
+
+
+class FakeClock(object):
+    """Stands in for `monotonic` and `sleep`, so that backoffs take no time"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(retry, "monotonic", clock.monotonic)
+    monkeypatch.setattr(retry, "sleep", clock.sleep)
+    # always back off by the longest possible delay
+    monkeypatch.setattr(retry, "uniform", lambda low, high: high)
+    return clock
+
+
+def client_error(code, status=400):
+    return ClientError(
+        {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}},
+        "PutObject",
+    )
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f"HTTP error with code {status}", response=response)
+
+
+def test_queue_yields_items_in_order(clock):
+    assert list(RetryQueue(["a", "b", "c"])) == [("a", 1), ("b", 1), ("c", 1)]
+
+
+def test_queue_does_not_hold_up_other_items_during_a_backoff(clock):
+    queue = RetryQueue(["a", "b", "c"], base_delay=1.0)
+    seen = []
+    for item, attempt in queue:
+        seen.append((item, attempt))
+        if item == "a" and attempt == 1:
+            assert queue.retry(item, attempt) == 1.0
+    assert seen == [("a", 1), ("b", 1), ("c", 1), ("a", 2)]
+    assert clock.slept == [1.0]
+
+
+def test_queue_backs_off_exponentially_up_to_the_limit(clock):
+    queue = RetryQueue(["a"], max_attempts=10, base_delay=1.0, max_delay=5.0)
+    delays = [queue.retry("a", attempt) for attempt in range(1, 6)]
+    assert delays == [1.0, 2.0, 4.0, 5.0, 5.0]
+
+
+def test_queue_gives_up_after_max_attempts(clock):
+    queue = RetryQueue(["a"], max_attempts=2)
+    assert queue.retry("a", 1) is not None
+    assert queue.retry("a", 2) is None
+    assert len(queue) == 2
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        requests.ConnectionError("connection reset"),
+        requests.Timeout("timed out"),
+        EndpointConnectionError(endpoint_url="https://s3.amazonaws.com"),
+        client_error("SlowDown", 503),
+        client_error("ExpiredToken", 400),
+        S3UploadFailedError(
+            "Failed to upload a.fcs: An error occurred (RequestTimeout) when calling the PutObject operation"
+        ),
+        S3UploadFailedError("Failed to upload a.fcs: connection dropped"),
+        http_error(429),
+        http_error(502),
+    ],
+)
+def test_transient_errors(error):
+    assert is_transient(error)
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        FileNotFoundError("a.fcs"),
+        PermissionError("a.fcs"),
+        client_error("AccessDenied", 403),
+        S3UploadFailedError(
+            "Failed to upload a.fcs: An error occurred (AccessDenied) when calling the PutObject operation"
+        ),
+        http_error(401),
+        http_error(404),
+        # without a response there is no status to go on
+        requests.HTTPError("HTTP error with code 503"),
+    ],
+)
+def test_permanent_errors(error):
+    assert not is_transient(error)
+
+
+def test_error_code():
+    assert error_code(client_error("SlowDown")) == "SlowDown"
+    assert (
+        error_code(
+            S3UploadFailedError(
+                "Failed to upload a.fcs: An error occurred (ExpiredToken) when calling the PutObject operation"
+            )
+        )
+        == "ExpiredToken"
+    )
+    assert error_code(ValueError("SlowDown")) is None
+
+
+def test_outcome_round_trips_through_a_dict():
+    outcome = UploadOutcome(Path("a.fcs"), "failed", 3, "timed out", True)
+    restored = UploadOutcome.from_dict(json.loads(json.dumps(outcome.to_dict())))
+    assert restored.to_dict() == outcome.to_dict()
+    assert str(restored) == "a.fcs: failed (timed out)"
+
+
+def test_report_counts_every_outcome(tmp_path):
+    report_file = tmp_path / "report.json"
+    write_report(
+        [
+            UploadOutcome(Path("a.fcs"), "uploaded", 1),
+            UploadOutcome(Path("b.fcs"), "failed", 5, "timed out", True),
+            UploadOutcome(Path("c.fcs"), "skipped", 0, "same name as a.fcs"),
+        ],
+        report_file,
+    )
+    report = json.loads(report_file.read_text())
+    assert (report["uploaded"], report["skipped"], report["failed"]) == (1, 1, 1)
+    assert report["failed_files"] == ["b.fcs"]
+    assert [_["status"] for _ in report["files"]] == ["uploaded", "failed", "skipped"]